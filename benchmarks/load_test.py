@@ -0,0 +1,106 @@
+'''
+Load test for the HTTP translation service (src/server.py): many concurrent clients send single sentences, and the
+throughput and latency are compared between dynamic micro-batching and one generate call per request
+(a maximum batch size of 1).
+
+By default the server runs in this process on the tiny offline model of benchmarks/suite.py. Give --url to test
+a running server with the real model instead:
+
+    python benchmarks/load_test.py --requests 500 --concurrency 64
+    python -m src.server --port 8000 &
+    python benchmarks/load_test.py --url http://127.0.0.1:8000
+'''
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import httpx
+from suite import setup, sentences, percentile, TAGALOG
+
+async def load(url:str, texts:list, concurrency:int) -> dict:
+    '''
+    Send every text as its own request, with at most `concurrency` requests in flight.
+
+    Returns:
+        dict: the achieved requests/s, the latency percentiles and the number of failed requests per status code
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = {}
+
+    async with httpx.AsyncClient(base_url=url, timeout=120.0, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def request(text:str):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post("/translate", json={"text": text})
+                if response.status_code == 200:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    failures[response.status_code] = failures.get(response.status_code, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(request(text) for text in texts))
+        seconds = time.perf_counter() - start
+        metrics = (await client.get("/metrics")).json()
+
+    return {
+        "requests_per_second": len(latencies) / seconds,
+        "p50_ms": percentile(latencies, 0.5) * 1000 if latencies else 0.0,
+        "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else 0.0,
+        "failures": failures,
+        "mean_batch_size": metrics["mean_batch_size"],
+    }
+
+async def local(texts:list, concurrency:int, max_batch_size:int, max_wait_ms:float, max_queue:int) -> dict:
+    from src.nllbtranslator import NLLBTranslator
+    from src.server import TranslationServer
+
+    server = TranslationServer(NLLBTranslator("tgl_Latn", "eng_Latn", "benchmark"), port=0, max_batch_size=max_batch_size,
+                               max_wait_ms=max_wait_ms, max_queue=max_queue)
+    await server.start()
+    try:
+        # Warm up the model before measuring
+        await load("http://127.0.0.1:{}".format(server.port), texts[:8], 8)
+        return await load("http://127.0.0.1:{}".format(server.port), texts, concurrency)
+    finally:
+        await server.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the translation service")
+    parser.add_argument("--url", help="test a running server instead of one on the offline model")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    parser.add_argument("--max-queue", type=int, default=1024)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    texts = sentences(TAGALOG, args.requests, 0, max_words=15)
+    if args.url:
+        results = {"server": asyncio.run(load(args.url, texts, args.concurrency))}
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            setup(directory)
+            results = {
+                "per_request": asyncio.run(local(texts, args.concurrency, 1, 0.0, args.max_queue)),
+                "micro_batched": asyncio.run(local(texts, args.concurrency, args.max_batch_size, args.max_wait_ms, args.max_queue)),
+            }
+
+    print("{:15s} {:>10s} {:>10s} {:>10s} {:>12s}  {}".format("mode", "req/s", "p50 ms", "p99 ms", "batch size", "failures"))
+    for mode, result in results.items():
+        print("{:15s} {:10.1f} {:10.1f} {:10.1f} {:12.1f}  {}".format(mode, result["requests_per_second"], result["p50_ms"],
+                                                                     result["p99_ms"], result["mean_batch_size"], result["failures"] or "-"))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+'''
+Shows that the corpus preprocessing in Data scales linearly: synthetic line-aligned files of growing size are
+streamed into Arrow files and the time per line should stay flat.
+
+    python benchmarks/preprocess_scaling.py --sizes 1000 10000 100000 1000000
+'''
+import argparse
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.data import Data
+
+WORDS = "ang baha sa bayan ng mga tao lungsod ilog barangay ulan bagyo lumikas pamilya kalsada tulay".split()
+
+def write_corpus(directory:str, lines:int) -> tuple:
+    '''
+    Write a synthetic line-aligned corpus with some empty and already translated lines.
+
+    Returns:
+        tuple: the paths of the source and target file
+    '''
+    random.seed(lines)
+    src_path = os.path.join(directory, "src.txt")
+    tgt_path = os.path.join(directory, "tgt.txt")
+    with open(src_path, "w") as src, open(tgt_path, "w") as tgt:
+        for i in range(lines):
+            sentence = " ".join(random.choices(WORDS, k=random.randint(3, 30)))
+            if i % 50 == 0:
+                src.write("\n")
+                tgt.write("\n")
+            elif i % 20 == 0:
+                src.write(sentence + "\n")
+                tgt.write(sentence + "\n")
+            else:
+                src.write(sentence + "\n")
+                tgt.write(sentence.upper() + "\n")
+    return src_path, tgt_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how corpus preprocessing scales with the number of lines")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10**3, 10**4, 10**5, 10**6])
+    args = parser.parse_args()
+
+    data = Data()
+    print("{:>10s} {:>10s} {:>12s} {:>14s} {:>12s}".format("lines", "kept", "seconds", "us/line", "peak RSS MB"))
+    with tempfile.TemporaryDirectory() as directory:
+        for lines in args.sizes:
+            src_path, tgt_path = write_corpus(directory, lines)
+
+            start = time.perf_counter()
+            kept = data.write_arrow(data.read_pairs(src_path, tgt_path), os.path.join(directory, "out.arrow"))
+            seconds = time.perf_counter() - start
+
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            print("{:>10d} {:>10d} {:>12.3f} {:>14.3f} {:>12.1f}".format(lines, kept, seconds, seconds / lines * 1e6, max_rss))
+
+if __name__ == '__main__':
+    main()
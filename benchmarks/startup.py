@@ -0,0 +1,66 @@
+'''
+Measures the cold start time and peak memory of importing the package and of creating the classes, each in a fresh
+Python process. The "eager" rows import every submodule up front, the way `import src` used to.
+
+    python benchmarks/startup.py
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Every snippet runs in its own interpreter, so the measurements do not influence each other
+SNIPPETS = {
+    "import src (lazy)": "import src",
+    "import src (eager)": "import src.nllbtranslator, src.evaluation, src.data, src.googletrans",
+    "import main": "import main",
+    "Evaluation() + BLEU": "import src; src.Evaluation().bleu",
+    "Evaluation() + BLEU (eager)": "import src.evaluation, src.registry; e = src.Evaluation(); e.bleu; e.comet",
+}
+
+MEASURE = '''
+import resource, sys, time
+start = time.perf_counter()
+exec(sys.argv[1])
+seconds = time.perf_counter() - start
+print(seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+def measure(snippet:str, repeat:int) -> dict:
+    '''
+    Run the snippet in fresh interpreters and keep the fastest run.
+
+    Returns:
+        dict: the time in seconds and the peak resident memory in MB
+    '''
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", MEASURE, snippet], cwd=ROOT, capture_output=True, text=True, check=True)
+        seconds, max_rss = output.stdout.split()[-2:]
+        runs.append((float(seconds), int(max_rss) / 1024))
+    seconds, max_rss = min(runs)
+    return {'seconds': seconds, 'peak_rss_mb': max_rss}
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold start time and peak memory")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for name, snippet in SNIPPETS.items():
+        try:
+            results[name] = measure(snippet, args.repeat)
+            print("{:30s} {:8.3f}s {:10.1f} MB".format(name, results[name]['seconds'], results[name]['peak_rss_mb']))
+        except subprocess.CalledProcessError as e:
+            print("{:30s} failed: {}".format(name, e.stderr.strip().splitlines()[-1]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+'''
+Offline benchmark suite for the hot paths: translation, corpus preprocessing, tokenization for finetuning, evaluation
+and deduplication.
+Everything runs on CPU without downloads: the translation model is a tiny randomly initialised M2M100 (the NLLB
+architecture) with a sentencepiece vocabulary trained on a synthetic Tagalog/English corpus, BLEU is computed
+with sacrebleu directly, and segment-level chrF stands in for COMET. They are put in the registry, so the package
+code (Data.read_parallel, Evaluation.eval, compute_metrics, ...) runs unchanged on top of them.
+
+The absolute numbers say nothing about the real model, but they do show when a change makes one of the paths slower.
+
+    python benchmarks/suite.py --json results.json
+    python benchmarks/suite.py --baseline results.json --tolerance 0.15
+'''
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from src import registry
+from preprocess_scaling import write_corpus
+
+TAGALOG = "ang baha sa bayan ng mga tao lungsod ilog barangay ulan bagyo lumikas pamilya kalsada tulay Maynila Cebu".split()
+ENGLISH = "the flood in town of people city river village rain typhoon evacuated family road bridge Manila Cebu".split()
+
+def sentences(words:list, count:int, seed:int, min_words:int=3, max_words:int=30) -> list:
+    generator = random.Random(seed)
+    return [" ".join(generator.choices(words, k=generator.randint(min_words, max_words))) for _ in range(count)]
+
+class SacreBLEU:
+    '''
+    Stand-in for evaluate.load("sacrebleu") that needs no download, with the same compute signature.
+    '''
+
+    def compute(self, predictions:list, references:list) -> dict:
+        import sacrebleu
+        if references and isinstance(references[0], str):
+            references = [[reference] for reference in references]
+        bleu = sacrebleu.corpus_bleu(predictions, [list(r) for r in zip(*references)])
+        return {'score': bleu.score, 'counts': bleu.counts, 'totals': bleu.totals, 'precisions': bleu.precisions,
+                'bp': bleu.bp, 'sys_len': bleu.sys_len, 'ref_len': bleu.ref_len}
+
+class SegmentChrF:
+    '''
+    Stand-in for evaluate.load("comet") that needs no download: segment-level chrF with the same compute signature
+    and output, so Evaluation.eval runs its full path. It is far cheaper than COMET, which is benchmarked elsewhere.
+    '''
+
+    config_name = "default"
+
+    def compute(self, predictions:list, references:list, sources:list) -> dict:
+        import sacrebleu
+        scores = [sacrebleu.sentence_chrf(prediction, [reference]).score / 100 for prediction, reference in zip(predictions, references)]
+        return {'mean_score': sum(scores) / len(scores) if scores else 0.0, 'scores': scores}
+
+def setup(directory:str) -> None:
+    '''
+    Train a small sentencepiece vocabulary on a synthetic corpus and register it, a tiny random model and the
+    offline BLEU and COMET stand-ins in the registry in place of the real ones.
+    '''
+    import sentencepiece as spm
+    import torch
+    from transformers import NllbTokenizer, M2M100Config, M2M100ForConditionalGeneration
+
+    corpus = os.path.join(directory, "corpus.txt")
+    with open(corpus, "w") as f:
+        f.write("\n".join(sentences(TAGALOG, 2000, 0) + sentences(ENGLISH, 2000, 1)) + "\n")
+    prefix = os.path.join(directory, "spm")
+    spm.SentencePieceTrainer.train(input=corpus, model_prefix=prefix, vocab_size=90, model_type="unigram",
+                                   character_coverage=1.0, minloglevel=2)
+
+    tokenizer = NllbTokenizer(vocab_file=prefix + ".model", src_lang="tgl_Latn", tgt_lang="eng_Latn")
+    config = M2M100Config(vocab_size=len(tokenizer), d_model=64, encoder_layers=2, decoder_layers=2, encoder_attention_heads=4,
+                          decoder_attention_heads=4, encoder_ffn_dim=128, decoder_ffn_dim=128, max_position_embeddings=512,
+                          pad_token_id=tokenizer.pad_token_id, bos_token_id=tokenizer.bos_token_id,
+                          eos_token_id=tokenizer.eos_token_id, decoder_start_token_id=tokenizer.eos_token_id)
+    torch.manual_seed(0)
+    model = M2M100ForConditionalGeneration(config).eval()
+    # Random weights rarely produce an end of sentence token, so every output has the same fixed length
+    model.generation_config.max_length = 32
+
+    registry.register_tokenizer(tokenizer, src_lang="tgl_Latn", tgt_lang="eng_Latn")
+    registry.register_model(model)
+    registry.register_metric(SacreBLEU(), "sacrebleu")
+    registry.register_metric(SegmentChrF(), "comet")
+
+def fastest(function, repeat:int) -> float:
+    '''
+    Returns:
+        float: the fastest time in seconds of running the function repeat times, which is the least noisy measurement
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def percentile(values:list, q:float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def bench_translate(batch_sizes:list, requests:int) -> dict:
+    '''
+    Latency of translating one batch of sentences per call, and the source tokens translated per second.
+    '''
+    from src.nllbtranslator import NLLBTranslator
+
+    results = {}
+    for batch_size in batch_sizes:
+        translator = NLLBTranslator("tgl_Latn", "eng_Latn", "benchmark", batch_size=batch_size)
+        batches = [sentences(TAGALOG, batch_size, seed) for seed in range(requests + 1)]
+        translator.translate_uncached(batches[0], progress=False)
+
+        latencies = []
+        tokens = 0
+        for batch in batches[1:]:
+            start = time.perf_counter()
+            translator.translate_uncached(batch, progress=False)
+            latencies.append(time.perf_counter() - start)
+            tokens += sum(len(ids) for ids in translator.tokenizer(batch)["input_ids"])
+
+        results["batch_size_" + str(batch_size)] = {
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "tokens_per_second": tokens / sum(latencies),
+            "sentences_per_second": batch_size * len(latencies) / sum(latencies),
+        }
+    return results
+
+def bench_preprocess(sizes:list, directory:str, repeat:int) -> dict:
+    '''
+    Time per line of Data.preprocess on lists in memory, of streaming the files to Arrow alone, and of the whole
+    Data.read_parallel entry point: streaming, the random splits and the near-duplicate and leakage removal.
+    '''
+    from src.data import Data
+
+    data = Data()
+    results = {}
+    for lines in sizes:
+        src_path, tgt_path = write_corpus(directory, lines)
+        with open(src_path) as f:
+            src = f.readlines()
+        with open(tgt_path) as f:
+            tgt = f.readlines()
+
+        preprocess_seconds = fastest(lambda: data.preprocess(src, tgt), repeat)
+        arrow_seconds = fastest(lambda: data.write_arrow(data.read_pairs(src_path, tgt_path), os.path.join(directory, "out.arrow")), repeat)
+        read_parallel_seconds = fastest(lambda: quiet(data.read_parallel, src_path, tgt_path, src_path, tgt_path,
+                                                      work_dir=os.path.join(directory, "parallel_arrow"), seed=0), repeat)
+
+        results["lines_" + str(lines)] = {
+            "preprocess_us_per_line": preprocess_seconds / lines * 1e6,
+            "write_arrow_us_per_line": arrow_seconds / lines * 1e6,
+            "read_parallel_us_per_line": read_parallel_seconds / lines * 1e6,
+        }
+    return results
+
+def quiet(function, *args, **kwargs):
+    '''
+    Call the function without its prints, which would otherwise flood the output of the benchmark.
+    '''
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        return function(*args, **kwargs)
+
+def bench_tokenization(examples:int, repeat:int) -> dict:
+    '''
+    Throughput of preprocess_function, the tokenization of the finetuning data.
+    '''
+    from src.nllbtranslator import NLLBTranslator
+
+    translator = NLLBTranslator("tgl_Latn", "eng_Latn", "benchmark")
+    batch = {"translation": [{"tg": s, "en": t} for s, t in zip(sentences(TAGALOG, examples, 2), sentences(ENGLISH, examples, 3))]}
+
+    seconds = fastest(lambda: translator.preprocess_function(batch), repeat)
+
+    tokenized = translator.preprocess_function(batch)
+    tokens = sum(len(ids) for ids in tokenized["input_ids"]) + sum(len(ids) for ids in tokenized["labels"])
+    return {"examples_per_second": examples / seconds, "tokens_per_second": tokens / seconds}
+
+def bench_evaluation(segments:int, repeat:int) -> dict:
+    '''
+    Throughput of Evaluation.eval (BLEU and the COMET stand-in), and of Evaluation.compute_metrics, the validation
+    metric of finetuning, on token ids: decoding the predictions and labels and BLEU.
+    '''
+    import numpy as np
+    from src.evaluation import Evaluation
+    from src.nllbtranslator import NLLBTranslator
+
+    evaluation = Evaluation()
+    sources = sentences(TAGALOG, segments, 6)
+    predictions = sentences(ENGLISH, segments, 4)
+    references = sentences(ENGLISH, segments, 5)
+
+    eval_seconds = fastest(lambda: evaluation.eval(predictions, references, sources), repeat)
+
+    tokenizer = NLLBTranslator("tgl_Latn", "eng_Latn", "benchmark").tokenizer
+    def pad(texts:list, value:int) -> np.ndarray:
+        ids = tokenizer(texts, text_target=texts)["labels"]
+        padded = np.full((len(ids), max(len(row) for row in ids)), value)
+        for i, row in enumerate(ids):
+            padded[i, :len(row)] = row
+        return padded
+    eval_preds = (pad(predictions, tokenizer.pad_token_id), pad(references, -100))
+
+    compute_metrics_seconds = fastest(lambda: evaluation.compute_metrics(eval_preds), repeat)
+    return {"eval_segments_per_second": segments / eval_seconds, "compute_metrics_segments_per_second": segments / compute_metrics_seconds}
+
+def bench_dedup(pairs:int, repeat:int) -> dict:
+    '''
+    Throughput of Deduplicator.deduplicate_pairs, and how often its decisions differ from the exact Jaccard similarity
+    (Deduplicator.check) on a corpus with near-duplicates: every fifth pair repeats an earlier one with a changed word.
+    '''
+    from src.dedup import Deduplicator
+
+    generator = random.Random(7)
+    corpus = list(zip(sentences(TAGALOG, pairs, 8), sentences(ENGLISH, pairs, 9)))
+    for i in range(4, pairs, 5):
+        src, tgt = corpus[generator.randrange(i)]
+        words = src.split()
+        words[generator.randrange(len(words))] = generator.choice(TAGALOG)
+        corpus[i] = (" ".join(words), tgt)
+
+    deduplicator = Deduplicator()
+    seconds = fastest(lambda: deduplicator.deduplicate_pairs(corpus), repeat)
+    check = deduplicator.check(corpus, sample_size=min(pairs, 2000))
+    return {"pairs_per_second": pairs / seconds, "false_duplicate_rate": check["false_duplicate_rate"],
+            "missed_duplicate_rate": check["missed_duplicate_rate"]}
+
+def flatten(results:dict, prefix:str="") -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "/"))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+def compare(results:dict, baseline:dict, tolerance:float) -> list:
+    '''
+    Compare every measurement with the baseline. Rates ("_per_second") should not go down, times should not go up.
+
+    Returns:
+        list: the names of the measurements that got worse by more than the tolerance
+    '''
+    current = flatten(results["results"])
+    previous = flatten(baseline["results"])
+    regressions = []
+
+    print("\n{:60s} {:>12s} {:>12s} {:>8s}".format("measurement", "baseline", "current", "change"))
+    for name in sorted(current.keys() & previous.keys()):
+        if not previous[name]:
+            continue
+        change = current[name] / previous[name] - 1
+        worse = -change if name.endswith("_per_second") else change
+        flag = ""
+        if worse > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:60s} {:12.3f} {:12.3f} {:+7.1%}{}".format(name, previous[name], current[name], change, flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the translation, preprocessing, tokenization, evaluation and deduplication hot paths offline")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=20, help="number of translate calls per batch size")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10**3, 10**4, 10**5], help="corpus sizes, up to 10**6 for the full curve")
+    parser.add_argument("--examples", type=int, default=10000, help="number of examples to tokenize")
+    parser.add_argument("--segments", type=int, default=10000, help="number of segments to evaluate")
+    parser.add_argument("--pairs", type=int, default=10000, help="number of sentence pairs to deduplicate")
+    parser.add_argument("--repeat", type=int, default=3, help="keep the fastest of this many runs of the preprocessing, tokenization and evaluation benchmarks")
+    parser.add_argument("--threads", type=int, default=None, help="torch threads, all cores if not given")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare with the results in this file")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    import torch
+    import transformers
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "threads": torch.get_num_threads(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": {},
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        setup(directory)
+        benchmarks = {
+            "translate": lambda: bench_translate(args.batch_sizes, args.requests),
+            "preprocess": lambda: bench_preprocess(args.sizes, directory, args.repeat),
+            "tokenization": lambda: bench_tokenization(args.examples, args.repeat),
+            "evaluation": lambda: bench_evaluation(args.segments, args.repeat),
+            "dedup": lambda: bench_dedup(args.pairs, args.repeat),
+        }
+        for name, benchmark in benchmarks.items():
+            start = time.perf_counter()
+            results["results"][name] = benchmark()
+            print("{:14s} done in {:.1f}s".format(name, time.perf_counter() - start))
+            for key, value in flatten(results["results"][name]).items():
+                print("    {:50s} {:12.3f}".format(key, value))
+
+    results["meta"]["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\n{} regression(s) of more than {:.0%}".format(len(regressions), args.tolerance))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
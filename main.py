@@ -1,28 +1,108 @@
-from src import *
-from tqdm import tqdm
-from datasets.dataset_dict import DatasetDict
+from __future__ import annotations
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from datasets.dataset_dict import DatasetDict
+    from src import TranslationCache
 
-def main():
-    version = 'trivial'
+import argparse
+import os
+
+# The classes in src are loaded on first use, which keeps the start-up of this script fast
+import src
+
+def main(argv:list=None):
+    parser = argparse.ArgumentParser(description="Location-focused translation of flooding events in Tagalog news articles")
+    parser.add_argument("--stages", default="stages.json", help="file to write the per-stage timings to at the end (.json, or .prom for Prometheus)")
+    parser.add_argument("--profile", choices=["cprofile", "sample"], help="also profile the stages in --profile-stages, with cProfile or a sampling profiler")
+    parser.add_argument("--profile-stages", nargs="+", default=["translate", "finetuning"], help="the stages to profile, e.g. translate finetuning evaluate")
+    parser.add_argument("--profile-dir", default="profiles", help="directory to write the profiles to")
+    commands = parser.add_subparsers(dest="command", required=True)
     
-    # create_train_test_split(version)
+    split = commands.add_parser("split", help="create and save the train/valid/test split of the files listed in paths.txt")
+    split.add_argument("version", help="the name to save the split as")
+    split.add_argument("--paths", default="paths.txt", help="file with the paths to the train source, train target, test source and test target files")
+    split.add_argument("--test-split", type=float, default=0.2)
+    split.add_argument("--seed", type=int, default=42)
     
-    data = load_data(version)
-    # save_txtfile(data, version)
+    translate = commands.add_parser("translate", help="translate a split into sharded JSONL predictions, resuming where an earlier run stopped")
+    translate.add_argument("version", help="the split to translate, and the finetuned model to use with nllb-finetuned")
+    translate.add_argument("--system", choices=["nllb", "nllb-finetuned", "google"], default="nllb")
+    translate.add_argument("--out", help="directory for the prediction shards, predictions/<version>/<system> by default")
+    translate.add_argument("--split", default="test")
+    translate.add_argument("--shard-size", type=int, default=2000, help="sentences per shard, the unit of resuming")
+    translate.add_argument("--sync-every", type=int, default=200, help="sentences between two fsyncs of the current shard")
+    translate.add_argument("--batch-size", type=int, default=16)
+    translate.add_argument("--max-tokens", type=int)
+    translate.add_argument("--engine", default="torch", choices=["torch", "int8", "onnx"])
+    translate.add_argument("--workers", type=int, default=1)
+    translate.add_argument("--articles", action="store_true", help="the split holds whole articles, translated in chunks")
+    translate.add_argument("--cache", help="SQLite translation cache, e.g. translations.sqlite")
+    translate.add_argument("--rate", type=float, default=5.0, help="Google Translate requests per second")
+    translate.add_argument("--concurrency", type=int, default=4, help="Google Translate requests in flight")
     
-    print(data)
+    finetune = commands.add_parser("finetune", help="finetune NLLB on a split and save it as finetuned_<version>/")
+    finetune.add_argument("version")
+    finetune.add_argument("--locations", help="directory with the gold location pickles, to report location recall during validation")
+    finetune.add_argument("--batch-size", type=int, default=8)
+    finetune.add_argument("--gradient-accumulation-steps", type=int, default=1)
+    finetune.add_argument("--gradient-checkpointing", action="store_true")
+    finetune.add_argument("--group-by-length", action="store_true")
+    finetune.add_argument("--max-tokens", type=int, help="batch the training data by this many tokens instead of by batch size")
+    finetune.add_argument("--epochs", type=int, default=1)
+    finetune.add_argument("--fast-eval", action="store_true", help="validate on a subsample during training")
+    finetune.add_argument("--eval-samples", type=int, default=200)
+    finetune.add_argument("--eval-loss-only", action="store_true")
+    finetune.add_argument("--full-eval-every", type=int)
     
-    nllbfinetuning(data, version)
+    evaluate_parser = commands.add_parser("evaluate", help="score prediction directories written by translate")
+    evaluate_parser.add_argument("version", help="the split the predictions belong to")
+    evaluate_parser.add_argument("predictions", nargs="+", help="prediction directories")
+    evaluate_parser.add_argument("--names", nargs="+", help="distinct names of the systems, by default the system in every directory, or the directories if those repeat")
+    evaluate_parser.add_argument("--score-cache", help="SQLite cache for COMET segment scores, e.g. scores.sqlite")
+    evaluate_parser.add_argument("--locations", help="directory with the gold location pickles, to also report location recall")
     
-    # pred_NLLB = nllb(data, version, finetuned=False)
-    # pred_NLLB_finetuned = nllb(data, version, finetuned=True)
-    # pred_GT = googletranslate(data)
-    # pred_GT_manual = load_pred_txtfile('googletrans'+version+'.txt')
+    trim_parser = commands.add_parser("trim", help="save a copy of NLLB with only the vocabulary of a split as finetuned_<out>/")
+    trim_parser.add_argument("version", help="the split to take the vocabulary from, and the finetuned model to trim with --finetuned")
+    trim_parser.add_argument("--out", help="the version to save the trimmed model as, <version>-trimmed by default")
+    trim_parser.add_argument("--finetuned", action="store_true", help="trim finetuned_<version>/ instead of the base model")
+    trim_parser.add_argument("--parity-samples", type=int, default=200, help="test sentences to compare the trimmed and the original model on, 0 to skip")
     
-    # order_list = ["NLLB", "NLLB finetuned", "Google Translate auto", "Google Translate manual"]
-    # pred = [pred_NLLB, pred_NLLB_finetuned, pred_GT, pred_GT_manual]
+    args = parser.parse_args(argv)
     
-    # evaluate(data, pred, order_list=order_list)
+    # Time every stage of the run and write a summary at the end
+    src.instrumentation.enable(profile=args.profile, profile_stages=args.profile_stages, profile_dir=args.profile_dir)
+    try:
+        if args.command == "split":
+            create_train_test_split(args.version, paths_file=args.paths, test_split=args.test_split, seed=args.seed)
+        elif args.command == "translate":
+            translate_shards(load_data(args.version), args.version, args.system, out_dir=args.out, split=args.split, shard_size=args.shard_size,
+                             sync_every=args.sync_every, batch_size=args.batch_size, max_tokens=args.max_tokens, engine=args.engine,
+                             workers=args.workers, articles=args.articles, cache_path=args.cache, rate=args.rate, concurrency=args.concurrency)
+        elif args.command == "finetune":
+            nllbfinetuning(load_data(args.version), args.version, locations_path=args.locations, batch_size=args.batch_size,
+                           gradient_accumulation_steps=args.gradient_accumulation_steps, gradient_checkpointing=args.gradient_checkpointing,
+                           group_by_length=args.group_by_length, max_tokens=args.max_tokens, num_train_epochs=args.epochs,
+                           fast_eval=args.fast_eval, eval_samples=args.eval_samples, eval_loss_only=args.eval_loss_only,
+                           full_eval_every=args.full_eval_every)
+        elif args.command == "trim":
+            trim(load_data(args.version), args.version, out_version=args.out, finetuned=args.finetuned, parity_samples=args.parity_samples)
+        elif args.command == "evaluate":
+            predictions = [src.ShardedPredictions(directory) for directory in args.predictions]
+            names = args.names or [prediction.meta["system"] for prediction in predictions]
+            if not args.names and len(set(names)) < len(names):
+                names = [os.path.normpath(directory) for directory in args.predictions]
+            # The predictions are scored against the split they were translated from, written before it was recorded means test
+            splits = {prediction.meta.get("split", "test") for prediction in predictions}
+            if len(splits) > 1:
+                raise ValueError("the predictions are of different splits: " + ", ".join(sorted(splits)))
+            split = splits.pop()
+            pred = [list(prediction) for prediction in predictions]
+            if len(pred) == 1:
+                evaluate(load_data(args.version), pred[0], score_cache_path=args.score_cache, locations_path=args.locations, split=split)
+            else:
+                evaluate(load_data(args.version), pred, order_list=names, score_cache_path=args.score_cache, locations_path=args.locations, split=split)
+    finally:
+        src.instrumentation.export(args.stages)
     
 def load_pred_txtfile(filename:str) -> list:
     '''
@@ -47,34 +127,36 @@ def save_txtfile(data:DatasetDict, version:str) -> None:
         data: the dataset the test set in the source language comes from
     '''
     with open("tagalog"+version+".txt","w") as wr:
-        for line in data["test"]:
-            wr.write(line['translation']['tg'] + '\n\n')
+        for line in src.Data().sources(data):
+            wr.write(line + '\n\n')
 
-def create_train_test_split(version_name:str) -> None:
+def create_train_test_split(version_name:str, paths_file:str="paths.txt", test_split:float=0.2, seed:int=42) -> None:
     '''
-    Creates a train/test split and saves that split as a pickle.
+    Creates a train/test split and saves that split as memory-mapped Arrow files.
+    If the input files and split parameters did not change since the last time, the saved split is kept.
     '''
-    # paths.txt contains 2 lines of text:
-    # 1. the path to the file containing the source language
-    # 2. the path to the file containing the target language
-    path_file = open("paths.txt", 'r')
-    paths = path_file.read().splitlines()
+    # paths.txt contains 4 lines of text, the paths to the files with:
+    # 1. the training data in the source language
+    # 2. the training data in the target language
+    # 3. the test data in the source language
+    # 4. the test data in the target language
+    with open(paths_file, 'r') as path_file:
+        paths = path_file.read().splitlines()
     
-    data = Data()
-    parallel = data.read_parallel(paths[0],paths[1],paths[2],paths[3])
-    data.save_train_test_split(parallel, version_name)
+    data = src.Data()
+    data.create_split(paths, version_name, test_split=test_split, seed=seed)
 
 def load_data(version_name:str) -> DatasetDict:
     '''
-    Loads the pickled train/test split created with 'create_train_test_split()'
+    Loads the train/test split created with 'create_train_test_split()'
     
     Returns:
         DatasetDict: the loaded parallel train/test split
     '''
-    data = Data()
+    data = src.Data()
     return data.read_train_test_split(version_name)
     
-def evaluate(parallel:DatasetDict, pred:list, single_sentence:bool=False, order_list:list=[]) -> None:
+def evaluate(parallel:DatasetDict, pred:list, single_sentence:bool=False, order_list:list=[], score_cache_path:str=None, locations_path:str=None, split:str="test") -> None:
     '''
     Evaluate a prediction using the BLEU and COMET scores.
     
@@ -82,29 +164,49 @@ def evaluate(parallel:DatasetDict, pred:list, single_sentence:bool=False, order_
         parallel: the parallel dataset containing the text in source and target language
         pred: the predicted translation
         single_sentence: whether we want to see a single sentence example
+        order_list: the names of the systems the predictions come from
+        score_cache_path: optional file to cache COMET segment scores in, so re-evaluations only score new segments
+        locations_path: optional directory with the gold location pickles, to also report location recall, and the recall
+            per location category and relevance level when the predictions are for the evaluation articles
+        split: the split the predictions were translated from, its references and sources are scored against
     '''
-    eval = Evaluation()
-    labels = [parallel["test"][i]['translation']['en'] for i in range(len(parallel['test']))]
-    sources = [parallel["test"][i]['translation']['tg'] for i in range(len(parallel['test']))]
+    score_cache = src.ScoreCache(score_cache_path) if score_cache_path else None
+    eval = src.Evaluation(score_cache=score_cache, locations_path=locations_path)
+    labels = src.Data().references(parallel, split)
+    sources = src.Data().sources(parallel, split)
     
     if single_sentence:
-        print("original: " + parallel["test"][0]['translation']['tg'])
+        print("original: " + sources[0])
         print("pred: " + str(pred[0]))
-        print("label: "+ parallel["test"][0]['translation']['en'])
-        print(eval.eval([pred[0]], [parallel["test"][0]['translation']['en']], [parallel["test"][0]['translation']['tg']]))
+        print("label: "+ labels[0])
+        print(eval.eval([pred[0]], [labels[0]], [sources[0]]))
     if type(pred[0])==list:
+        if len(order_list) != len(pred) or len(set(order_list)) != len(order_list):
+            raise ValueError("every system needs its own name, got " + str(order_list) + " for " + str(len(pred)) + " system(s)")
+        # All systems are scored together, so segments they have in common are only scored once
+        evaluations = eval.eval_systems(dict(zip(order_list, pred)), labels, sources)
         with open("all_scores.txt","w") as wr:
             for i in range(len(pred)):
-                evaluation = eval.eval(pred[i], labels, sources)
+                evaluation = evaluations[order_list[i]]
                 wr.write('------------' + order_list[i] + '------------\n')
                 wr.write('BLEU: ' + str(evaluation['bleu']['score']) + '\n')
                 wr.write('COMET: ' + str(evaluation['comet']['mean_score']) + '\n')
+                if 'location_recall' in evaluation:
+                    wr.write('Location recall: ' + str(evaluation['location_recall']) + '\n')
+                if locations_path and len(pred[i]) == len(eval.locations.locations):
+                    evaluation['location_recall_breakdown'] = eval.location_recall(pred[i])
+                    for key, value in sorted(evaluation['location_recall_breakdown'].items()):
+                        wr.write('Location ' + key + ': ' + str(value) + '\n')
                 wr.write('Full eval: ' + str(evaluation))
                 wr.write('\n\n')
     else:
-        print(eval.eval(pred, labels, sources))
+        evaluation = eval.eval(pred, labels, sources)
+        # Predictions for the evaluation articles are also scored on their gold locations, per category and relevance level
+        if locations_path and len(pred) == len(eval.locations.locations):
+            evaluation['location_recall_breakdown'] = eval.location_recall(pred)
+        print(evaluation)
     
-def nllb(parallel:DatasetDict, version:str, finetuned=False) -> list: 
+def nllb(parallel:DatasetDict, version:str, finetuned=False, batch_size:int=16, max_tokens:int=None, cache:TranslationCache=None, articles:bool=False, workers:int=1, engine:str="torch") -> list: 
     '''
     Generates the predicted translations using Meta's No Language Left Behind (NLLB) model.
     
@@ -112,45 +214,137 @@ def nllb(parallel:DatasetDict, version:str, finetuned=False) -> list:
         parallel: the parallel dataset containing the text in source and target language
         version: which version of the finetuned model to use
         finetuned: bool whether to use the finetuned version of the model or not
+        batch_size: the maximum number of sentences translated at once
+        max_tokens: the maximum number of (padded) source tokens translated at once
+        cache: optional translation cache, so sentences that were translated before are not translated again
+        articles: whether the test set contains whole articles, which are translated in chunks and put back together line by line
+        workers: the number of worker processes to translate with, each loading its own copy of the model
+        engine: the inference engine, "torch" (fp32), "int8" (dynamically quantized) or "onnx" (ONNX Runtime)
         
     Returns:
         list: the predicted translations in the target language
     '''
-    translator = NLLBTranslator(src="tgl_Latn", tgt="eng_Latn", version=version, finetuned=finetuned)
-    test = [parallel["test"][i]['translation']['tg'] for i in range(len(parallel['test']))]
+    test = src.Data().sources(parallel)
+    
+    if workers > 1:
+        print("Translating " + str(len(test)) + " sentence(s) with " + str(workers) + " workers")
+        with src.TranslationPool(src="tgl_Latn", tgt="eng_Latn", version=version, finetuned=finetuned, workers=workers, batch_size=batch_size, max_tokens=max_tokens, cache=cache, engine=engine) as pool:
+            return pool.translate(test, articles=articles)
+    
+    translator = src.NLLBTranslator(src="tgl_Latn", tgt="eng_Latn", version=version, finetuned=finetuned, batch_size=batch_size, max_tokens=max_tokens, cache=cache, engine=engine)
+
+    if articles:
+        return translator.translate_articles(test)
 
     print("Translating " + str(len(test)) + " sentence(s)")
-    pred = list(tqdm(map(translator.translate, test),total=len(test))) # For a list of sentences
+    pred = translator.translate(test)
     
     return pred
     
-def nllbfinetuning(parallel:DatasetDict, version:str) -> None:
+def nllbfinetuning(parallel:DatasetDict, version:str, locations_path:str=None, **kwargs) -> None:
     '''
     Finetunes Meta's No Language Left Behind (NLLB) model on the given data. The model is automatically saved to the directory.
     
     Args:
         parallel: the parallel dataset containing the text in source and target language
         version: which version to save the finetuned model as
+        locations_path: optional directory with the gold location pickles, to also report location recall during validation
+        kwargs: training options of NLLBTranslator.finetuning, e.g. max_tokens=1024, gradient_accumulation_steps=4 and
+            gradient_checkpointing=True to train with larger effective batches in the same memory
     '''
-    translator = NLLBTranslator(src="tgl_Latn", tgt="eng_Latn", version=version)
-    eval = Evaluation()
-    translator.finetuning(parallel, eval)
+    translator = src.NLLBTranslator(src="tgl_Latn", tgt="eng_Latn", version=version)
+    eval = src.Evaluation(locations_path=locations_path)
+    translator.finetuning(parallel, eval, **kwargs)
     
-def googletranslate(parallel:DatasetDict) -> list:
+def trim(parallel:DatasetDict, version:str, out_version:str=None, finetuned:bool=False, parity_samples:int=200) -> dict:
+    '''
+    Saves a copy of NLLB with only the tokens used in the given data, which loads and decodes faster, and compares it with the original.
+    
+    Args:
+        parallel: the parallel dataset, all splits are scanned for the tokens to keep
+        version: which version of the finetuned model to trim, with finetuned
+        out_version: which version to save the trimmed model as, <version>-trimmed by default
+        finetuned: bool whether to trim the finetuned version of the model or the base model
+        parity_samples: the number of test sentences to compare the models on, 0 to skip the comparison
+        
+    Returns:
+        dict: the report of VocabularyTrimmer.parity_check, or None without a comparison
+    '''
+    out_version = out_version or version + "-trimmed"
+    translator = src.NLLBTranslator(src="tgl_Latn", tgt="eng_Latn", version=version, finetuned=finetuned)
+    trimmer = src.VocabularyTrimmer(translator)
+    trimmer.export(parallel, out_version)
+    
+    data = src.Data()
+    sources = data.sources(parallel)
+    mismatches = trimmer.verify_tokenization(sources, out_version)
+    print(str(mismatches) + " of " + str(len(sources)) + " test sentence(s) tokenized differently by the trimmed tokenizer")
+    
+    if parity_samples:
+        return trimmer.parity_check(sources, data.references(parallel), src.Evaluation(), out_version, sample_size=parity_samples)
+    
+def googletranslate(parallel:DatasetDict, cache:TranslationCache=None, checkpoint_path:str=None, rate:float=5.0, concurrency:int=4) -> list:
     '''
     Generates the predicted translations using Google's Google Translate.
     
     Args:
         parallel: the parallel dataset containing the text in source and target language
+        cache: optional translation cache, so sentences that were translated before are not translated again
+        checkpoint_path: optional file to store finished translations in, so an interrupted run can resume
+        rate: the maximum number of requests per second
+        concurrency: the maximum number of requests in flight at the same time
         
     Returns:
         list: the predicted translations in the target language
     '''
-    translator = GoogleTranslate()
-    test = [parallel["test"][i]['translation']['tg'] for i in range(len(parallel['test']))]
+    translator = src.AsyncGoogleTranslate(rate=rate, concurrency=concurrency, checkpoint_path=checkpoint_path, cache=cache)
+    test = src.Data().sources(parallel)
     print("Translating " + str(len(test)) + " sentence(s)")
     pred = translator.translate(test)   
     return pred
     
+def translate_shards(parallel:DatasetDict, version:str, system:str="nllb", out_dir:str=None, split:str="test", shard_size:int=2000,
+                     sync_every:int=200, batch_size:int=16, max_tokens:int=None, engine:str="torch", workers:int=1, articles:bool=False,
+                     cache_path:str=None, rate:float=5.0, concurrency:int=4) -> src.ShardedPredictions:
+    '''
+    Translates a split into sharded JSONL predictions, see ShardedPredictions. Only one shard is held in memory,
+    and shards that are complete from an earlier run of the same job are skipped.
+    
+    Args:
+        parallel: the parallel dataset containing the text in source and target language
+        version: which version of the finetuned model to use with "nllb-finetuned"
+        system: "nllb", "nllb-finetuned" or "google"
+        out_dir: the directory for the shards, predictions/<version>/<system> by default
+        split: the split to translate
+        
+    Returns:
+        ShardedPredictions: the predictions, to be read lazily
+    '''
+    out_dir = out_dir or os.path.join("predictions", os.path.basename(os.path.normpath(version)), system)
+    predictions = src.ShardedPredictions(out_dir, shard_size=shard_size, sync_every=sync_every)
+    cache = src.TranslationCache(cache_path) if cache_path else None
+    data = src.Data()
+    total = len(parallel[split])
+    sources = lambda start, end: data.source_slice(parallel, start, end, split)
+    
+    print("Translating " + str(total) + " sentence(s) of " + split + " with " + system + " into " + out_dir)
+    if system == "google":
+        translator = src.AsyncGoogleTranslate(rate=rate, concurrency=concurrency, cache=cache)
+        predictions.translate(total, sources, translator.translate, system, split=split)
+    elif workers > 1:
+        # The pool gets a whole shard at once, so all workers stay busy, and the translations are written as they come in
+        with src.TranslationPool(src="tgl_Latn", tgt="eng_Latn", version=version, finetuned=system == "nllb-finetuned", workers=workers,
+                                 batch_size=batch_size, max_tokens=max_tokens, cache=cache, engine=engine) as pool:
+            if cache is None:
+                predictions.translate(total, sources, lambda batch: pool.imap(batch, articles=articles), system, split=split, streaming=True)
+            else:
+                predictions.translate(total, sources, lambda batch: pool.translate(batch, articles=articles), system, split=split, streaming=True)
+    else:
+        translator = src.NLLBTranslator(src="tgl_Latn", tgt="eng_Latn", version=version, finetuned=system == "nllb-finetuned",
+                                        batch_size=batch_size, max_tokens=max_tokens, cache=cache, engine=engine)
+        predictions.translate(total, sources, translator.translate_articles if articles else translator.translate, system, split=split)
+    
+    return predictions
+    
 if __name__ == '__main__':
     main()
\ No newline at end of file
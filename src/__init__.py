@@ -1,7 +1,27 @@
-from .nllbtranslator import NLLBTranslator
-from .evaluation import Evaluation
-from .data import Data
-from .googletrans import GoogleTranslate
+import importlib
 
-__all__ = ["nllbtranslator","evaluation","data","googletrans",
-           "NLLBTranslator","Evaluation","Data","GoogleTranslate"]
\ No newline at end of file
+# The submodules pull in heavy dependencies (torch, transformers, datasets, ...), so they are only imported
+# the first time one of their classes is used.
+_classes = {"NLLBTranslator": "nllbtranslator", "Evaluation": "evaluation", "Data": "data",
+            "GoogleTranslate": "googletrans", "AsyncGoogleTranslate": "asyncgoogletrans",
+            "TranslationCache": "cache", "ScoreCache": "cache", "TranslationPool": "pool", "Deduplicator": "dedup", "LocationIndex": "locations",
+            "Gazetteer": "gazetteer", "Masker": "masking", "MaskingPipeline": "masking",
+            "TokenBudgetBatchSampler": "training", "FinetuningTrainer": "training",
+            "MicroBatcher": "server", "TranslationServer": "server", "ShardedPredictions": "predictions",
+            "VocabularyTrimmer": "trim"}
+
+__all__ = ["nllbtranslator","evaluation","data","googletrans","asyncgoogletrans","cache","pool","registry","dedup","locations","gazetteer","masking","training","instrumentation","server","predictions","trim",
+           "NLLBTranslator","Evaluation","Data","GoogleTranslate","AsyncGoogleTranslate","TranslationCache","ScoreCache","TranslationPool","Deduplicator","LocationIndex","Gazetteer","Masker","MaskingPipeline","TokenBudgetBatchSampler","FinetuningTrainer","MicroBatcher","TranslationServer","ShardedPredictions","VocabularyTrimmer"]
+
+def __getattr__(name:str):
+    if name in _classes:
+        value = getattr(importlib.import_module("." + _classes[name], __name__), name)
+    elif name in __all__:
+        value = importlib.import_module("." + name, __name__)
+    else:
+        raise AttributeError("module '" + __name__ + "' has no attribute '" + name + "'")
+    globals()[name] = value
+    return value
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(__all__))
\ No newline at end of file
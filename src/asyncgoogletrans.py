@@ -0,0 +1,267 @@
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .asyncgoogletrans import AsyncGoogleTranslate
+
+from .cache import TranslationCache
+from . import instrumentation
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+import httpx
+import tqdm
+
+class TokenBucket:
+    '''
+    Token-bucket rate limiter: on average at most `rate` requests per second, with bursts of at most `capacity`.
+    '''
+
+    def __init__(self, rate:float, capacity:int=1):
+        self.rate = rate
+        self.max_rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        '''
+        Wait until a token is available and take it.
+        '''
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def slow_down(self) -> None:
+        '''
+        Halve the rate after the server told us we are sending too many requests.
+        '''
+        self.rate = max(self.max_rate / 64, self.rate / 2)
+
+    def speed_up(self) -> None:
+        '''
+        Slowly recover the rate after a successful request.
+        '''
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+class ThrottledError(Exception):
+    '''
+    The server refused the request because of rate limiting, or is temporarily unavailable.
+    '''
+
+    def __init__(self, status_code:int, retry_after:float=None):
+        super().__init__("HTTP {}".format(status_code))
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class AsyncGoogleTranslate:
+    '''
+    Concurrent Google Translate backend. Short lines are packed together into a single request, requests are sent
+    concurrently under a token-bucket rate limit, and failed requests are retried with exponential backoff and jitter.
+    '''
+
+    def __init__(self, src_lang="tl", dest_code='en', rate:float=5.0, concurrency:int=4, max_chars:int=3000, max_lines:int=32,
+                 max_retries:int=8, base_delay:float=1.0, max_delay:float=120.0, timeout:float=30.0,
+                 url:str="https://translate.googleapis.com/translate_a/single", checkpoint_path:str=None, cache:TranslationCache=None) -> None:
+        self.src_lang = src_lang
+        self.dest_code = dest_code
+        self.rate = rate
+        self.concurrency = concurrency
+        self.max_chars = max_chars
+        self.max_lines = max_lines
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.url = url
+        self.checkpoint_path = checkpoint_path
+        self.cache = cache
+        self.requests = 0
+
+    @instrumentation.timed("googletrans")
+    def translate(self, src:list) -> list:
+        '''
+        Translate the given lines using Google Translate.
+        If a cache was given, only the lines that were not translated before are sent to Google Translate.
+
+        Args:
+            src: a list of strings in the source language
+
+        Returns:
+            list: a list of the predicted translations in the target language of the source strings
+        '''
+        if self.cache is not None:
+            return self.cache.translate(src, self.translate_uncached, self.src_lang, self.dest_code, "googletrans", "web")
+        return self.translate_uncached(src)
+
+    def translate_uncached(self, src:list) -> list:
+        '''
+        Translate the given lines using Google Translate, without consulting the cache.
+        If a checkpoint path was given, finished lines are read from and appended to that file, so an interrupted run can resume.
+
+        Args:
+            src: a list of strings in the source language
+
+        Returns:
+            list: a list of the predicted translations in the target language of the source strings
+        '''
+        return asyncio.run(self.translate_async(src))
+
+    async def translate_async(self, src:list) -> list:
+        '''
+        Coroutine version of translate_uncached, for use inside a running event loop.
+        '''
+        translations = self.load_checkpoint(src)
+
+        # Empty lines are not sent to Google Translate, they are kept as is
+        for i, line in enumerate(src):
+            if translations[i] is None and line.strip() == "":
+                translations[i] = line
+
+        todo = [i for i in range(len(src)) if translations[i] is None]
+        packs = self.pack(src, todo)
+        print("Translating {} line(s) in {} request(s), {} line(s) already done".format(len(todo), len(packs), len(src) - len(todo)))
+
+        bucket = TokenBucket(self.rate, capacity=max(1, self.concurrency))
+        semaphore = asyncio.Semaphore(self.concurrency)
+        checkpoint = open(self.checkpoint_path, 'a', encoding='utf-8') if self.checkpoint_path else None
+        start = time.monotonic()
+        self.requests = 0
+
+        try:
+            async with httpx.AsyncClient(timeout=self.timeout) as client:
+                tasks = [self._indexed(n, self.translate_pack(client, bucket, semaphore, [src[i] for i in pack])) for n, pack in enumerate(packs)]
+                progress = tqdm.tqdm(total=len(todo))
+                for task in asyncio.as_completed(tasks):
+                    n, lines = await task
+                    for i, translation in zip(packs[n], lines):
+                        translations[i] = translation
+                        if checkpoint:
+                            checkpoint.write(json.dumps({'index': i, 'source': self.source_hash(src[i]), 'translation': translation}, ensure_ascii=False) + "\n")
+                    if checkpoint:
+                        checkpoint.flush()
+                    progress.update(len(packs[n]))
+                progress.close()
+        finally:
+            if checkpoint:
+                checkpoint.close()
+
+        elapsed = time.monotonic() - start
+        if self.requests:
+            print("Sent {} request(s) in {:.1f}s ({:.2f} requests/s)".format(self.requests, elapsed, self.requests / elapsed))
+        return translations
+
+    async def _indexed(self, n:int, task) -> tuple:
+        return n, await task
+
+    @staticmethod
+    def source_hash(line:str) -> str:
+        return hashlib.sha256(line.encode("utf-8")).hexdigest()
+
+    def load_checkpoint(self, src:list) -> list:
+        '''
+        Read the translations that were finished in a previous run. Entries are only used for a line with the same
+        source text, so a checkpoint of other input (another file, or only the lines missing from the cache) is ignored.
+
+        Args:
+            src: a list of strings in the source language
+
+        Returns:
+            list: the finished translations, None for lines that still need to be translated
+        '''
+        translations = [None] * len(src)
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line may be incomplete if the previous run was killed while writing
+                        continue
+                    index = entry['index']
+                    if index < len(src) and entry.get('source') == self.source_hash(src[index]):
+                        translations[index] = entry['translation']
+        return translations
+
+    def pack(self, src:list, indices:list) -> list:
+        '''
+        Pack consecutive short lines into requests of at most max_chars characters and max_lines lines.
+
+        Args:
+            src: a list of strings in the source language
+            indices: the indices of the lines that have to be translated
+
+        Returns:
+            list: lists of indices into src, one list per request
+        '''
+        packs = []
+        pack = []
+        chars = 0
+        for i in indices:
+            length = len(src[i]) + 1
+            if pack and (chars + length > self.max_chars or len(pack) == self.max_lines):
+                packs.append(pack)
+                pack = []
+                chars = 0
+            pack.append(i)
+            chars += length
+        if pack:
+            packs.append(pack)
+        return packs
+
+    async def translate_pack(self, client:httpx.AsyncClient, bucket:TokenBucket, semaphore:asyncio.Semaphore, lines:list) -> list:
+        '''
+        Translate several lines in one request and split the result back into lines.
+        If the number of lines does not survive the round trip, the lines are translated one by one instead.
+        '''
+        lines = [line.replace("\n", " ").strip() for line in lines]
+        translation = await self.request(client, bucket, semaphore, "\n".join(lines))
+        translated = translation.split("\n")
+
+        if len(translated) != len(lines):
+            translated = [await self.request(client, bucket, semaphore, line) for line in lines]
+        return [line.strip() for line in translated]
+
+    async def request(self, client:httpx.AsyncClient, bucket:TokenBucket, semaphore:asyncio.Semaphore, text:str) -> str:
+        '''
+        Send a single translation request, retrying throttled and failed requests with exponential backoff.
+        '''
+        params = {'client': 'gtx', 'sl': self.src_lang, 'tl': self.dest_code, 'dt': 't'}
+
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            try:
+                async with semaphore:
+                    self.requests += 1
+                    response = await client.post(self.url, params=params, data={'q': text})
+                if response.status_code in (429, 503):
+                    retry_after = response.headers.get("Retry-After")
+                    raise ThrottledError(response.status_code, float(retry_after) if retry_after and retry_after.isdigit() else None)
+                if response.status_code >= 500:
+                    raise ThrottledError(response.status_code)
+                response.raise_for_status()
+
+                bucket.speed_up()
+                return "".join(segment[0] for segment in response.json()[0] if segment[0])
+
+            except ThrottledError as e:
+                if attempt == self.max_retries:
+                    raise
+                if e.status_code == 429:
+                    bucket.slow_down()
+                # Respect the delay the server asked for, otherwise back off exponentially with full jitter
+                delay = e.retry_after if e.retry_after is not None else random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+            except httpx.TransportError:
+                if attempt == self.max_retries:
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+            await asyncio.sleep(delay)
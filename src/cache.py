@@ -0,0 +1,235 @@
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .cache import SQLiteCache, TranslationCache
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+class SQLiteCache:
+    '''
+    A persistent key-value store in a single SQLite file. When the stored values grow larger than
+    max_bytes, the least recently used entries are evicted.
+    '''
+
+    # SQLite limits the number of variables in a single query
+    chunk_size = 500
+
+    def __init__(self, path:str, max_bytes:int=1024**3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, size INTEGER, accessed REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self.connection.commit()
+
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def get_many(self, keys:list) -> dict:
+        '''
+        Look up several keys at once.
+
+        Args:
+            keys: the keys to look up
+
+        Returns:
+            dict: the stored value for every key that was found
+        '''
+        found = {}
+        for i in range(0, len(keys), self.chunk_size):
+            chunk = keys[i:i+self.chunk_size]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute("SELECT key, value FROM entries WHERE key IN (" + placeholders + ")", chunk)
+            found.update(rows.fetchall())
+
+        if found:
+            now = time.time()
+            self.connection.executemany("UPDATE entries SET accessed = ? WHERE key = ?", [(now, key) for key in found])
+            self.connection.commit()
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, items:dict) -> None:
+        '''
+        Store several values at once and evict old entries if the cache became too large.
+
+        Args:
+            items: the values to store, by key
+        '''
+        if not items:
+            return
+
+        # Size of the entries that are about to be replaced
+        keys = list(items)
+        previous = 0
+        for i in range(0, len(keys), self.chunk_size):
+            chunk = keys[i:i+self.chunk_size]
+            placeholders = ",".join("?" * len(chunk))
+            previous += self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries WHERE key IN (" + placeholders + ")", chunk).fetchone()[0]
+
+        now = time.time()
+        rows = [(key, value, len(value.encode("utf-8")), now) for key, value in items.items()]
+        self.connection.executemany("INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)", rows)
+        self.connection.commit()
+
+        self.size += sum(row[2] for row in rows) - previous
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self) -> None:
+        '''
+        Remove the least recently used entries until the cache is below 90% of its maximum size.
+        '''
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        target = 0.9 * self.max_bytes
+
+        while self.size > target:
+            rows = self.connection.execute("SELECT key, size FROM entries ORDER BY accessed LIMIT ?", (self.chunk_size,)).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.size <= target:
+                    break
+                self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.size -= size
+        self.connection.commit()
+
+    def stats(self) -> dict:
+        '''
+        Returns:
+            dict: the number of hits, misses and entries and the size of the cache in bytes
+        '''
+        entries = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': entries, 'bytes': self.size}
+
+    def close(self) -> None:
+        self.connection.close()
+
+class TranslationCache(SQLiteCache):
+    '''
+    A translation cache shared by the translation backends. Entries are addressed by the hash of the
+    source text, the language pair, the backend and the identity of the model that produced them.
+    '''
+
+    def __init__(self, path:str="translations.sqlite", max_bytes:int=1024**3):
+        super().__init__(path, max_bytes)
+
+    def key(self, text:str, src_lang:str, tgt_lang:str, backend:str, model_id:str) -> str:
+        '''
+        Create the cache key for a single source text.
+
+        Returns:
+            str: the hex digest that identifies the translation
+        '''
+        content = json.dumps([backend, model_id, src_lang, tgt_lang, text], ensure_ascii=False)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def translate(self, src:list, translate_function, src_lang:str, tgt_lang:str, backend:str, model_id:str) -> list:
+        '''
+        Translate a list of strings, only calling translate_function for the strings that are not cached yet.
+
+        Args:
+            src: list of strings in the source language
+            translate_function: function that translates a list of strings and returns a list of translations
+            src_lang: the language code of the source language
+            tgt_lang: the language code of the target language
+            backend: the name of the translation backend
+            model_id: the identity of the model, including its generation settings
+
+        Returns:
+            list: the translations in the target language, in the same order as src
+        '''
+        keys = [self.key(text, src_lang, tgt_lang, backend, model_id) for text in src]
+        cached = self.get_many(list(dict.fromkeys(keys)))
+
+        # Translate every missing string only once, even if it occurs several times
+        missing = {}
+        for key, text in zip(keys, src):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        if missing:
+            print("Translation cache: {} cached, {} to translate".format(len(cached), len(missing)))
+            translated = dict(zip(missing, translate_function(list(missing.values()))))
+            self.set_many(translated)
+            cached.update(translated)
+
+        return [cached[key] for key in keys]
+
+def model_fingerprint(path:str) -> str:
+    '''
+    Hash the contents of a model checkpoint directory, so translations from different checkpoints are never mixed up.
+
+    Args:
+        path: the checkpoint directory
+
+    Returns:
+        str: the hex digest of all files in the directory
+    '''
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).encode("utf-8"))
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(block)
+    return digest.hexdigest()
+
+class ScoreCache(SQLiteCache):
+    '''
+    A cache of segment-level metric scores, addressed by the hash of the (source, prediction, reference) triple
+    and the metric version, so every unique segment is only scored once.
+    '''
+
+    def __init__(self, path:str="scores.sqlite", max_bytes:int=256*1024**2):
+        super().__init__(path, max_bytes)
+
+    def key(self, source:str, prediction:str, reference:str, metric:str) -> str:
+        '''
+        Create the cache key for a single segment.
+
+        Returns:
+            str: the hex digest that identifies the score
+        '''
+        content = json.dumps([metric, source, prediction, reference], ensure_ascii=False)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def score(self, triples:list, score_function, metric:str) -> list:
+        '''
+        Score a list of segments, only calling score_function for the segments that are not cached yet.
+
+        Args:
+            triples: list of (source, prediction, reference) tuples
+            score_function: function that scores a list of triples and returns a list of floats
+            metric: the name and version of the metric
+
+        Returns:
+            list: the score of every segment, in the same order as triples
+        '''
+        keys = [self.key(*triple, metric) for triple in triples]
+        cached = {key: float(value) for key, value in self.get_many(list(dict.fromkeys(keys))).items()}
+
+        missing = {}
+        for key, triple in zip(keys, triples):
+            if key not in cached and key not in missing:
+                missing[key] = triple
+
+        if missing:
+            print("Score cache: {} cached, {} to score".format(len(cached), len(missing)))
+            scored = dict(zip(missing, score_function(list(missing.values()))))
+            self.set_many({key: repr(float(value)) for key, value in scored.items()})
+            cached.update(scored)
+
+        return [cached[key] for key in keys]
\ No newline at end of file
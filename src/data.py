@@ -2,20 +2,32 @@ from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from .data import Data
     
-from datasets import load_dataset
+from .dedup import Deduplicator
+from . import instrumentation
+from datasets import Dataset, load_from_disk
 from datasets.dataset_dict import DatasetDict
 import pandas as pd
+import pyarrow as pa
+import hashlib
+import json
+import os
 import pickle 
+import tempfile
 
 class Data:
     
+    # Arrow schema of the parallel data, the same columns preprocess creates
+    schema = pa.schema([('id', pa.int64()), ('translation', pa.struct([('tg', pa.string()), ('en', pa.string())]))])
+    
     def __init__(self):
         pass
     
-    def read_parallel(self, src_path_train:str, tgt_path_train:str, src_path_test:str, tgt_path_test:str, test_split:int=0.2) -> DatasetDict:
+    @instrumentation.timed("read_parallel")
+    def read_parallel(self, src_path_train:str, tgt_path_train:str, src_path_test:str, tgt_path_test:str, test_split:int=0.2, work_dir:str="parallel_arrow", seed:int=None, dedup:bool=True, leakage:str="remove") -> DatasetDict:
         '''
         Reads parallel data that is aligned line by line and turns it into a dataset.
         The data is preprocessed to not contain newlines or sentences that are identical in both languages.
+        The files are streamed into Arrow files in work_dir, so the whole corpus is never held in memory.
         
         Args:
             src_path_train: the path to the file with the training data in the source language 
@@ -23,39 +35,33 @@ class Data:
             src_path_test: the path to the file with the test data in the source language 
             tgt_path_test: the path to the file with the test data in the target language 
             test_split: percentage how much of the train/test split should be test data
+            work_dir: the directory to write the preprocessed Arrow files to, the returned dataset is memory-mapped
+                from it, so it must be kept until the dataset is saved, see create_split
+            seed: the seed for the random splits, so the same split can be made again
+            dedup: whether to remove near-duplicate pairs within every split and pairs that leak from train/valid into test
+            leakage: "remove" to drop the pairs that leak into a later split, or "flag" to mark them in a "leaked" column
         
         Returns:
             DatasetDict: the parallel dataset containing the text in source and target language
         '''
-        # Read text into dataframe
-        src_file_train = open(src_path_train, 'r')
-        src_train = src_file_train.readlines()
-        tgt_file_train = open(tgt_path_train, 'r')
-        tgt_train = tgt_file_train.readlines()
-        src_file_test = open(src_path_test, 'r')
-        src_test = src_file_test.readlines()
-        tgt_file_test = open(tgt_path_test, 'r')
-        tgt_test = tgt_file_test.readlines()
-        
-        dataframe_train = self.preprocess(src_train, tgt_train)
-        dataframe_test = self.preprocess(src_test, tgt_test)
+        os.makedirs(work_dir, exist_ok=True)
+        filename_train = os.path.join(work_dir, "train.arrow")
+        filename_test = os.path.join(work_dir, "test.arrow")
         
-        # Save dataframe
-        filename_train = 'pickle_train.p'
-        dataframe_train.to_pickle(filename_train)
+        # Stream the line pairs straight into Arrow files
+        with instrumentation.stage("arrow"):
+            self.write_arrow(self.read_pairs(src_path_train, tgt_path_train), filename_train)
+            self.write_arrow(self.read_pairs(src_path_test, tgt_path_test), filename_test)
         
-        filename_test = 'pickle_test.p'
-        dataframe_test.to_pickle(filename_test)
+        # Memory-map the Arrow files as datasets
+        data_train = Dataset.from_file(filename_train)
+        data_test = Dataset.from_file(filename_test)
         
-        # Load dataframe as dataset
-        data_train = load_dataset('pandas', data_files=filename_train)
-        data_test = load_dataset('pandas', data_files=filename_test)
-        
-        data_train = data_train["train"].train_test_split(test_size=test_split)
+        data_train = data_train.train_test_split(test_size=test_split, seed=seed)
 
         # We do this because the test set is way too large otherwise and manual evaluation will be unfeasible
         # Feel free to remove this line later on when you have the official (smaller) test set
-        data_test = data_test["train"].train_test_split(test_size=0.9)
+        data_test = data_test.train_test_split(test_size=0.9, seed=seed)
         
         print(data_train["train"][0:10])
 
@@ -65,13 +71,71 @@ class Data:
             'test': data_test['train']
         })
         
+        if dedup:
+            with instrumentation.stage("dedup"):
+                data = Deduplicator().clean(data, leakage=leakage)
+        
         print(data)
         
         return data
     
+    def read_pairs(self, src_path:str, tgt_path:str):
+        '''
+        Read two line-aligned files in lockstep and yield the pairs that should be kept: pairs where either side
+        is empty or where both sides are identical (already translated) are skipped.
+        
+        Args:
+            src_path: the path to the file in the source language
+            tgt_path: the path to the file in the target language
+            
+        Yields:
+            tuple: the source and target sentence without newlines
+        '''
+        with open(src_path, 'r') as src_file, open(tgt_path, 'r') as tgt_file:
+            for src, tgt in zip(src_file, tgt_file):
+                src = src.replace("\n", "")
+                tgt = tgt.replace("\n", "")
+                if src != "" and tgt != "" and src != tgt:
+                    yield src, tgt
+    
+    def write_arrow(self, pairs, filename:str, batch_size:int=100000) -> int:
+        '''
+        Write sentence pairs to an Arrow stream file in record batches, with an id and a translation column.
+        
+        Args:
+            pairs: iterable of (source, target) tuples
+            filename: the file to write to
+            batch_size: the number of pairs per record batch
+            
+        Returns:
+            int: the number of pairs written
+        '''
+        count = 0
+        with pa.OSFile(filename, 'wb') as sink, pa.ipc.new_stream(sink, self.schema) as writer:
+            src = []
+            tgt = []
+            for pair in pairs:
+                src.append(pair[0])
+                tgt.append(pair[1])
+                if len(src) == batch_size:
+                    writer.write_batch(self.record_batch(src, tgt, count))
+                    count += len(src)
+                    src = []
+                    tgt = []
+            if src or count == 0:
+                writer.write_batch(self.record_batch(src, tgt, count))
+                count += len(src)
+        
+        return count
+    
+    def record_batch(self, src:list, tgt:list, start:int) -> pa.RecordBatch:
+        translation = pa.StructArray.from_arrays([pa.array(src, pa.string()), pa.array(tgt, pa.string())], fields=list(self.schema.field('translation').type))
+        return pa.RecordBatch.from_arrays([pa.array(range(start, start + len(src)), pa.int64()), translation], schema=self.schema)
+    
     def preprocess(self, src:list[str], tgt:list[str]) -> pd.DataFrame:
         """
         Remove newlines, remove already translated sentences and turn the data into the correct format.
+        Pairs where either side is empty are removed together, so the sentences stay aligned.
         
         Args:
             src: a list of the text in the source language
@@ -81,56 +145,122 @@ class Data:
             pandas.Dataframe: a Dataframe with the data in the correct format
         """
         
-        # Remove all newlines
-        for i in range(len(src)):
-            src[i] = src[i].replace("\n", "")
-        for i in range(len(tgt)):
-            tgt[i] = tgt[i].replace("\n", "")
-            
-        while("" in src):
-            src.remove("")
-        while("" in tgt):
-            tgt.remove("")
-            
-        # Remove sentences that are already translated
-        duplicates = []
-        for i in range(len(src)):
-            if src[i] == tgt[i]:
-                duplicates.append(i)
-                
-        src = [src[i] for i in range(len(src)) if i not in duplicates]
-        tgt = [tgt[i] for i in range(len(tgt)) if i not in duplicates]
-        
-        assert len(src) == len(tgt)
+        # Remove newlines, empty pairs and sentences that are already translated in a single pass
+        pairs = [(s.replace("\n", ""), t.replace("\n", "")) for s, t in zip(src, tgt)]
+        pairs = [(s, t) for s, t in pairs if s != "" and t != "" and s != t]
         
         # { {'id':0, 'translation': {'eng':english, 'tgl':tagalog} }, {'id':1, 'translation': {'eng':english1, 'tgl':tagalog1 } }, ... }
-        translation = [ {'tg':src[i], 'en':tgt[i]} for i in range(len(src)) ]
-        id = [i for i in range(len(translation))]
+        translation = [ {'tg':s, 'en':t} for s, t in pairs ]
         
-        data = [id, translation]
-        
-        dataframe = pd.DataFrame(data).transpose()
-        dataframe.columns =['id','translation']
+        dataframe = pd.DataFrame({'id': range(len(translation)), 'translation': translation})
         
         return dataframe
     
-    def save_train_test_split(self, parallel:DatasetDict, version_name:str) -> None:
+    def create_split(self, paths:list, version_name:str, test_split:float=0.2, seed:int=42, dedup:bool=True, leakage:str="remove") -> DatasetDict:
         '''
-        Pickle the given dataset and save it to the directory.
+        Create a train/test split from the given files and save it, unless a split of exactly the same files
+        with the same parameters was saved before. In that case the saved split is loaded instead.
+        
+        Args:
+            paths: the paths to the train source, train target, test source and test target files
+            version_name: the name to save the split as
+            test_split: percentage how much of the train/test split should be test data
+            seed: the seed for the random split
+            dedup: whether to remove near-duplicates and train/test leakage
+            leakage: "remove" or "flag" the pairs that leak into a later split
+            
+        Returns:
+            DatasetDict: the parallel dataset containing the text in source and target language
+        '''
+        fingerprint = self.fingerprint(paths, test_split=test_split, seed=seed, dedup=dedup, leakage=leakage)
+        if self.saved_fingerprint(version_name) == fingerprint:
+            print("Reusing the saved split " + version_name + ", the input files and parameters did not change")
+            return self.read_train_test_split(version_name)
+        
+        # The intermediate Arrow files and the cache files of the splits and the deduplication are only needed until
+        # the split is saved, so they are written to a temporary directory that is removed afterwards
+        with tempfile.TemporaryDirectory() as work_dir:
+            parallel = self.read_parallel(paths[0], paths[1], paths[2], paths[3], test_split=test_split, work_dir=work_dir, seed=seed, dedup=dedup, leakage=leakage)
+            self.save_train_test_split(parallel, version_name, fingerprint)
+            del parallel
+        
+        # Memory-map the saved split, the returned dataset must not point into the removed directory
+        return self.read_train_test_split(version_name)
+    
+    def fingerprint(self, paths:list, **params) -> str:
+        '''
+        Hash the contents of the input files together with the split parameters.
+        
+        Args:
+            paths: the input files
+            params: the parameters of the split
+            
+        Returns:
+            str: the hex digest of the files and parameters
+        '''
+        digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8"))
+        for path in paths:
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(block)
+            digest.update(b"\0")
+        return digest.hexdigest()
+    
+    def saved_fingerprint(self, version_name:str) -> str:
+        '''
+        Returns:
+            str: the fingerprint the split was saved with, or None if there is no saved split
+        '''
+        path = os.path.join(version_name, "fingerprint.json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)["fingerprint"]
+    
+    def save_train_test_split(self, parallel:DatasetDict, version_name:str, fingerprint:str=None) -> None:
+        '''
+        Save the given dataset as Arrow files in the directory version_name, together with the fingerprint of the data it was made from.
         
         Args:
             parallel: the parallel dataset containing the text in source and target language
+            version_name: the name to save the split as
+            fingerprint: the fingerprint of the input files and split parameters
         '''
-        with open(version_name+'.pkl', 'wb') as f:
-            pickle.dump(parallel, f)
+        parallel.save_to_disk(version_name)
+        with open(os.path.join(version_name, "fingerprint.json"), 'w') as f:
+            json.dump({"fingerprint": fingerprint}, f)
     
+    @instrumentation.timed("load_data")
     def read_train_test_split(self, version_name:str) -> DatasetDict:
         '''
-        Read the previously saved dataset from the directory.
+        Read the previously saved dataset from the directory. The Arrow files are memory-mapped, not copied into memory.
+        Splits that were pickled by an older version are still read.
         
         Returns:
             DatasetDict: the parallel dataset containing the text in source and target language
         '''
-        with open(version_name+'.pkl', 'rb') as f:
-            loaded_dict = pickle.load(f)
-        return loaded_dict
\ No newline at end of file
+        if not os.path.isdir(version_name) and os.path.exists(version_name+'.pkl'):
+            with open(version_name+'.pkl', 'rb') as f:
+                return pickle.load(f)
+        return load_from_disk(version_name)
+    
+    def sources(self, parallel:DatasetDict, split:str="test") -> list:
+        '''
+        Returns:
+            list: all sentences in the source language of the given split, read column-wise
+        '''
+        return parallel[split].flatten()["translation.tg"]
+    
+    def source_slice(self, parallel:DatasetDict, start:int, end:int, split:str="test") -> list:
+        '''
+        Returns:
+            list: the sentences in the source language from index start up to end, without reading the rest of the split
+        '''
+        return [translation['tg'] for translation in parallel[split][start:end]["translation"]]
+    
+    def references(self, parallel:DatasetDict, split:str="test") -> list:
+        '''
+        Returns:
+            list: all sentences in the target language of the given split, read column-wise
+        '''
+        return parallel[split].flatten()["translation.en"]
\ No newline at end of file
@@ -0,0 +1,279 @@
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .dedup import Deduplicator
+
+import hashlib
+import re
+import time
+import zlib
+import numpy as np
+
+class LSHIndex:
+    '''
+    Locality-sensitive hashing index over MinHash signatures: signatures are cut into bands, and two signatures
+    become candidates if they agree on all rows of at least one band.
+
+    The signatures are kept in one growing uint32 array (the lower 32 bits of every hash), which takes a fraction of
+    the memory of one array object per signature; a chance collision of 32-bit hashes hardly changes the estimate.
+    '''
+
+    def __init__(self, bands:int, rows:int):
+        self.bands = bands
+        self.rows = rows
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = np.empty((1024, bands * rows), dtype=np.uint32)
+        self.size = 0
+
+    def add(self, signature:np.ndarray) -> int:
+        '''
+        Add a signature to the index.
+
+        Returns:
+            int: the id of the signature in the index
+        '''
+        if self.size == len(self.signatures):
+            self.signatures = np.concatenate([self.signatures, np.empty_like(self.signatures)])
+        id = self.size
+        self.signatures[id] = signature.astype(np.uint32)
+        self.size += 1
+        for band in range(self.bands):
+            self.buckets[band].setdefault(self.signatures[id, band*self.rows:(band+1)*self.rows].tobytes(), []).append(id)
+        return id
+
+    def similar(self, signature:np.ndarray, threshold:float) -> bool:
+        '''
+        Whether the index contains a signature with an estimated Jaccard similarity of at least threshold.
+        '''
+        signature = signature.astype(np.uint32)
+        candidates = set()
+        for band in range(self.bands):
+            candidates.update(self.buckets[band].get(signature[band*self.rows:(band+1)*self.rows].tobytes(), ()))
+        if not candidates:
+            return False
+        # All candidates are compared in one vectorised step
+        agreement = (self.signatures[np.fromiter(candidates, dtype=np.int64, count=len(candidates))] == signature).mean(axis=1)
+        return bool((agreement >= threshold).any())
+
+class Deduplicator:
+    '''
+    Finds near-duplicate sentence pairs with MinHash signatures over character shingles and an LSH index,
+    which takes roughly linear instead of quadratic time in the number of pairs.
+    '''
+
+    # Mersenne prime for the universal hash functions
+    prime = (1 << 61) - 1
+
+    def __init__(self, threshold:float=0.8, num_perm:int=64, bands:int=16, shingle_size:int=5, seed:int=1):
+        assert num_perm % bands == 0, "num_perm has to be divisible by bands"
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+
+        # The universal hash functions (a * h + b) mod prime, with a and b drawn from the whole field
+        generator = np.random.default_rng(seed)
+        self.a = generator.integers(1, self.prime, size=(num_perm, 1), dtype=np.uint64)
+        self.b = generator.integers(0, self.prime, size=(num_perm, 1), dtype=np.uint64)
+        # a * h has up to 93 bits, so a is split into its lower 32 and upper 29 bits, see signature
+        self.a_low = self.a & np.uint64(0xFFFFFFFF)
+        self.a_high = self.a >> np.uint64(32)
+
+    def normalize(self, text:str) -> str:
+        return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+    def shingles(self, text:str, prefix:str="") -> set:
+        '''
+        Returns:
+            set: the character n-grams of the normalized text
+        '''
+        text = self.normalize(text)
+        if len(text) <= self.shingle_size:
+            return {prefix + text}
+        return {prefix + text[i:i+self.shingle_size] for i in range(len(text) - self.shingle_size + 1)}
+
+    def signature(self, shingles:set) -> np.ndarray:
+        '''
+        Returns:
+            numpy.ndarray: the MinHash signature of the set of shingles
+        '''
+        hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+
+        # a * h = a_high * h * 2^32 + a_low * h, where a_low * h < 2^64 and a_high * h < 2^61.
+        # With a_high * h = y1 * 2^29 + y0, (a_high * h * 2^32) mod prime = (y1 + y0 * 2^32) mod prime, since 2^61 = 1 mod prime.
+        high = self.a_high * hashes
+        high = mod_mersenne((high >> np.uint64(29)) + ((high & np.uint64((1 << 29) - 1)) << np.uint64(32)))
+        low = mod_mersenne(self.a_low * hashes)
+        # Each term is below the prime, so the sum stays below 2^63
+        return mod_mersenne(high + low + self.b).min(axis=1)
+
+    def index(self) -> LSHIndex:
+        return LSHIndex(self.bands, self.num_perm // self.bands)
+
+    def deduplicate(self, src:list, tgt:list) -> list:
+        '''
+        Find the pairs to keep when near-duplicate pairs are removed. Both sides of a pair are hashed together,
+        so a pair is only a duplicate if its source and target are both near-duplicates of an earlier pair.
+
+        Args:
+            src: the sentences in the source language
+            tgt: the sentences in the target language
+
+        Returns:
+            list: the indices of the pairs to keep, the first occurrence of every group of near-duplicates
+        '''
+        return self.deduplicate_pairs(zip(src, tgt)).tolist()
+
+    def deduplicate_pairs(self, pairs) -> np.ndarray:
+        '''
+        Like deduplicate, for an iterable of (source, target) pairs, e.g. read from a dataset in batches.
+        Exact duplicates are recognised by a 64-bit hash of the normalized pair instead of by the pair itself.
+
+        Returns:
+            numpy.ndarray: the indices of the pairs to keep
+        '''
+        index = self.index()
+        exact = set()
+        keep = []
+        for i, (s, t) in enumerate(pairs):
+            normalized = hash_pair(self.normalize(s), self.normalize(t))
+            if normalized in exact:
+                continue
+
+            signature = self.signature(self.shingles(s, "s:") | self.shingles(t, "t:"))
+            if index.similar(signature, self.threshold):
+                continue
+
+            exact.add(normalized)
+            index.add(signature)
+            keep.append(i)
+        return np.array(keep, dtype=np.int64)
+
+    def leaks(self, src:list, tgt:list, held_out_src:list, held_out_tgt:list) -> list:
+        '''
+        Flag the pairs whose source or target sentence is a near-duplicate of a sentence on the same side of the held-out data.
+
+        Args:
+            src: the sentences in the source language to check
+            tgt: the sentences in the target language to check
+            held_out_src: the held-out sentences in the source language
+            held_out_tgt: the held-out sentences in the target language
+
+        Returns:
+            list: for every pair whether it leaks into the held-out data
+        '''
+        return self.leaking_pairs(zip(src, tgt), zip(held_out_src, held_out_tgt)).tolist()
+
+    def leaking_pairs(self, pairs, held_out) -> np.ndarray:
+        '''
+        Like leaks, for iterables of (source, target) pairs.
+
+        Returns:
+            numpy.ndarray: for every pair whether it leaks into the held-out data
+        '''
+        indices = [self.index(), self.index()]
+        for s, t in held_out:
+            indices[0].add(self.signature(self.shingles(s, "s:")))
+            indices[1].add(self.signature(self.shingles(t, "t:")))
+
+        return np.fromiter((indices[0].similar(self.signature(self.shingles(s, "s:")), self.threshold)
+                            or indices[1].similar(self.signature(self.shingles(t, "t:")), self.threshold)
+                            for s, t in pairs), dtype=bool)
+
+    def check(self, pairs, sample_size:int=1000) -> dict:
+        '''
+        Compare the decisions of deduplicate_pairs with the exact Jaccard similarity on a sample: a pair should be
+        removed exactly if its shingles have a Jaccard similarity of at least threshold with a pair that was kept before it.
+        This is quadratic in the sample size, so only use it on a sample.
+
+        Args:
+            pairs: an iterable of (source, target) pairs, the first sample_size are checked
+            sample_size: the number of pairs to check
+
+        Returns:
+            dict: the number of checked pairs, of pairs removed although no kept pair is similar enough (false_duplicates)
+                and of pairs kept although a kept pair is similar enough (missed_duplicates), and their rates
+        '''
+        sample = [pair for _, pair in zip(range(sample_size), pairs)]
+        removed = np.ones(len(sample), dtype=bool)
+        removed[self.deduplicate_pairs(sample)] = False
+
+        shingles = [self.shingles(s, "s:") | self.shingles(t, "t:") for s, t in sample]
+        kept = []
+        false_duplicates = 0
+        missed_duplicates = 0
+        for i, current in enumerate(shingles):
+            duplicate = any(len(current & shingles[j]) >= self.threshold * len(current | shingles[j]) for j in kept)
+            false_duplicates += bool(removed[i] and not duplicate)
+            missed_duplicates += bool(duplicate and not removed[i])
+            if not removed[i]:
+                kept.append(i)
+
+        checked = max(len(sample), 1)
+        return {'pairs': len(sample), 'false_duplicates': false_duplicates, 'missed_duplicates': missed_duplicates,
+                'false_duplicate_rate': false_duplicates / checked, 'missed_duplicate_rate': missed_duplicates / checked}
+
+    def clean(self, parallel, leakage:str="remove", batch_size:int=10000):
+        '''
+        Remove near-duplicate pairs within every split, then remove or flag the pairs in train and valid that also
+        occur in a later split (train is checked against valid and test, valid against test).
+        The splits are read in batches of the Arrow table, so the sentences are never all held in Python lists.
+
+        Args:
+            parallel: the parallel dataset with train, valid and test splits
+            leakage: "remove" to drop leaking pairs, or "flag" to mark them in a boolean "leaked" column of every split
+            batch_size: the number of pairs to read at a time
+
+        Returns:
+            DatasetDict: the cleaned parallel dataset
+        '''
+        for split in parallel:
+            start = time.perf_counter()
+            keep = self.deduplicate_pairs(pairs(parallel[split], batch_size))
+            removed = len(parallel[split]) - len(keep)
+            parallel[split] = parallel[split].select(keep)
+            print("Dedup {}: removed {} near-duplicate pair(s), kept {} ({:.1f}s)".format(split, removed, len(keep), time.perf_counter() - start))
+
+        for split, later in [("valid", ["test"]), ("train", ["valid", "test"])]:
+            later = [other for other in later if other in parallel]
+            if split not in parallel or not later:
+                continue
+
+            start = time.perf_counter()
+            held_out = (pair for other in later for pair in pairs(parallel[other], batch_size))
+            leaked = self.leaking_pairs(pairs(parallel[split], batch_size), held_out)
+
+            if leakage == "remove":
+                parallel[split] = parallel[split].select(np.flatnonzero(~leaked))
+            else:
+                parallel[split] = parallel[split].add_column("leaked", leaked)
+            print("Leakage {} -> {}: {} {} pair(s) ({:.1f}s)".format(split, "/".join(later), "removed" if leakage == "remove" else "flagged",
+                                                                  int(leaked.sum()), time.perf_counter() - start))
+
+        # Every split gets the column, so all splits keep the same schema
+        if leakage == "flag":
+            for split in parallel:
+                if "leaked" not in parallel[split].column_names:
+                    parallel[split] = parallel[split].add_column("leaked", np.zeros(len(parallel[split]), dtype=bool))
+
+        return parallel
+
+def mod_mersenne(x:np.ndarray) -> np.ndarray:
+    '''
+    Returns:
+        numpy.ndarray: x mod (2^61 - 1) for unsigned 64-bit x, without a division
+    '''
+    prime = np.uint64(Deduplicator.prime)
+    x = (x & prime) + (x >> np.uint64(61))
+    return np.where(x >= prime, x - prime, x)
+
+def hash_pair(src:str, tgt:str) -> int:
+    return int.from_bytes(hashlib.blake2b((src + "\t" + tgt).encode("utf-8"), digest_size=8).digest(), "little")
+
+def pairs(dataset, batch_size:int=10000, source_lang:str="tg", target_lang:str="en"):
+    '''
+    Yields:
+        tuple: the source and target sentence of every pair of the dataset, read batch_size rows at a time
+    '''
+    for batch in dataset.iter(batch_size=batch_size):
+        for translation in batch["translation"]:
+            yield translation[source_lang], translation[target_lang]
@@ -2,18 +2,47 @@ from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from .evaluation import Evaluation
 
-import evaluate
+from . import registry
+from . import instrumentation
+from .cache import ScoreCache
+from .locations import LocationIndex
+from functools import cached_property
+from importlib.metadata import version, PackageNotFoundError
 import numpy as np
-from transformers import NllbTokenizer
 
 class Evaluation:
     
-    def __init__(self, src:str="tgl_Latn", tgt:str="eng_Latn"):
-        self.bleu = evaluate.load("sacrebleu")
-        self.comet = evaluate.load('comet')
+    def __init__(self, src:str="tgl_Latn", tgt:str="eng_Latn", score_cache:ScoreCache=None, comet_batch_size:int=64, comet_workers:int=None, locations_path:str=None):
+        self.src = src
+        self.tgt = tgt
         
-        self.tokenizer = NllbTokenizer.from_pretrained("facebook/nllb-200-distilled-600M", src_lang=src, tgt_lang=tgt)
+        # Directory with the gold location pickles, if location recall should be computed as well
+        self.locations_path = locations_path
+        
+        # Settings for scoring many systems at once with eval_systems
+        self.score_cache = score_cache
+        self.comet_batch_size = comet_batch_size
+        self.comet_workers = comet_workers
+    
+    # The metrics and the tokenizer are only loaded when they are first used, so e.g. computing BLEU
+    # during finetuning never loads the COMET model. They are shared with other instances through the registry.
+    @cached_property
+    def bleu(self):
+        return registry.metric("sacrebleu")
+    
+    @cached_property
+    def comet(self):
+        return registry.metric("comet")
     
+    @cached_property
+    def tokenizer(self):
+        return registry.tokenizer(src_lang=self.src, tgt_lang=self.tgt)
+    
+    @cached_property
+    def locations(self) -> LocationIndex:
+        return LocationIndex(self.locations_path)
+    
+    @instrumentation.timed("evaluate")
     def eval(self, predictions:list, labels:list, source:list) -> dict:
         '''
         Evaluates predicted translations using the BLEU and COMET scores.
@@ -24,13 +53,113 @@ class Evaluation:
             source: the text before translation in the source language
             
         Returns:
-            dict: the BLEU and COMET scores
+            dict: the BLEU and COMET scores, and the location recall if a locations path was given
         '''
         score = {}
-        score['bleu'] = self.bleu.compute(predictions=predictions, references=labels)
-        score['comet'] = self.comet.compute(predictions=predictions, references=labels, sources=source)
+        with instrumentation.stage("bleu"):
+            score['bleu'] = self.bleu.compute(predictions=predictions, references=labels)
+        with instrumentation.stage("comet"):
+            score['comet'] = self.comet.compute(predictions=predictions, references=labels, sources=source)
+        if self.locations_path:
+            score['location_recall'] = self.locations.reference_recall(predictions, labels)
         return score
     
+    def location_recall(self, predictions:list) -> dict:
+        '''
+        Evaluates how many of the gold locations of the evaluation articles are found in the predicted translations.
+        
+        Args:
+            predictions: the predicted translation of every evaluation article, with one line per line of the original
+            
+        Returns:
+            dict: the location recall overall, per location category and per relevance flag
+        '''
+        return self.locations.recall(predictions)
+    
+    @instrumentation.timed("evaluate_systems")
+    def eval_systems(self, systems:dict, labels:list, source:list) -> dict:
+        '''
+        Evaluates the predicted translations of several systems on the same data using the BLEU and COMET scores.
+        The (source, prediction, reference) triples of all systems are deduplicated and every unique triple is scored
+        with COMET only once, in large batches. If a score cache was given, segments that were scored before are not scored again.
+        
+        Args:
+            systems: the predicted translations in the target language of every system, by name
+            labels: the text in the target language
+            source: the text before translation in the source language
+            
+        Returns:
+            dict: the BLEU and COMET scores of every system, by name
+        '''
+        for name, predictions in systems.items():
+            if len(predictions) != len(labels) or len(source) != len(labels):
+                raise ValueError("system '{}' has {} prediction(s) for {} reference(s) and {} source(s)".format(name, len(predictions), len(labels), len(source)))
+        
+        triples = list(dict.fromkeys((s, p, l) for predictions in systems.values() for s, p, l in zip(source, predictions, labels)))
+        print("Scoring " + str(len(triples)) + " unique segment(s) for " + str(len(systems)) + " system(s)")
+        
+        if self.score_cache is not None:
+            scores = self.score_cache.score(triples, self.comet_segment_scores, self.comet_version())
+        else:
+            scores = self.comet_segment_scores(triples)
+        segment_scores = dict(zip(triples, scores))
+        
+        results = {}
+        for name, predictions in systems.items():
+            comet_scores = [segment_scores[triple] for triple in zip(source, predictions, labels)]
+            results[name] = {
+                'bleu': self.bleu.compute(predictions=predictions, references=labels),
+                'comet': {'mean_score': float(np.mean(comet_scores)) if comet_scores else 0.0, 'scores': comet_scores}
+            }
+            if self.locations_path:
+                results[name]['location_recall'] = self.locations.reference_recall(predictions, labels)
+        return results
+    
+    def comet_segment_scores(self, triples:list) -> list:
+        '''
+        Score segments with COMET in batches of comet_batch_size, using comet_workers data loader workers.
+        
+        Args:
+            triples: list of (source, prediction, reference) tuples
+            
+        Returns:
+            list: the COMET score of every segment
+        '''
+        import torch
+        
+        data = [{'src': s, 'mt': p, 'ref': l} for s, p, l in triples]
+        output = self.comet.scorer.predict(data, batch_size=self.comet_batch_size, gpus=1 if torch.cuda.is_available() else 0,
+                                           num_workers=self.comet_workers, progress_bar=True)
+        # Newer versions of COMET return a Prediction object, older ones a (scores, system score) tuple
+        return list(output.scores if hasattr(output, "scores") else output[0])
+    
+    def comet_checkpoint(self) -> str:
+        '''
+        Returns:
+            str: the name of the COMET checkpoint the metric loads. The "default" configuration of the evaluate
+                metric picks a checkpoint depending on the COMET version, the same way it is resolved here.
+        '''
+        if self.comet.config_name != "default":
+            return self.comet.config_name
+        try:
+            major = int(version("unbabel-comet").split(".")[0])
+        except (PackageNotFoundError, ValueError):
+            return "default"
+        return "Unbabel/wmt22-comet-da" if major >= 2 else "wmt20-comet-da"
+    
+    def comet_version(self) -> str:
+        '''
+        Returns:
+            str: the COMET checkpoint, and the COMET and evaluate versions, so cached scores from another COMET model are never used
+        '''
+        packages = []
+        for package in ["unbabel-comet", "evaluate"]:
+            try:
+                packages.append(version(package))
+            except PackageNotFoundError:
+                packages.append("unknown")
+        return "comet/" + self.comet_checkpoint() + "/" + "/".join(packages)
+    
     def compute_metrics(self, eval_pred):
         logits, labels = eval_pred
         predictions = np.argmax(logits, axis=-1)
@@ -42,19 +171,27 @@ class Evaluation:
 
         return preds, labels
 
+    @instrumentation.timed("compute_metrics")
     def compute_metrics(self, eval_preds):
         preds, labels = eval_preds
         if isinstance(preds, tuple):
             preds = preds[0]
-        decoded_preds = self.tokenizer.batch_decode(preds, skip_special_tokens=True)
+        with instrumentation.stage("decode"):
+            decoded_preds = self.tokenizer.batch_decode(preds, skip_special_tokens=True)
 
-        labels = np.where(labels != -100, labels, self.tokenizer.pad_token_id)
-        decoded_labels = self.tokenizer.batch_decode(labels, skip_special_tokens=True)
+            labels = np.where(labels != -100, labels, self.tokenizer.pad_token_id)
+            decoded_labels = self.tokenizer.batch_decode(labels, skip_special_tokens=True)
 
         decoded_preds, decoded_labels = self.postprocess_text(decoded_preds, decoded_labels)
 
-        result = self.bleu.compute(predictions=decoded_preds, references=decoded_labels)
+        with instrumentation.stage("bleu"):
+            result = self.bleu.compute(predictions=decoded_preds, references=decoded_labels)
         result = {"bleu": result["score"]}
+        
+        if self.locations_path:
+            location_recall = self.locations.reference_recall(decoded_preds, [label[0] for label in decoded_labels])
+            if location_recall is not None:
+                result["location_recall"] = location_recall
 
         prediction_lens = [np.count_nonzero(pred != self.tokenizer.pad_token_id) for pred in preds]
         result["gen_len"] = np.mean(prediction_lens)
@@ -0,0 +1,163 @@
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .gazetteer import Gazetteer
+
+from .locations import normalize
+import gzip
+import json
+
+class Gazetteer:
+    '''
+    Offline English -> Tagalog dictionary of place names, stored as a trie over words so the longest known name
+    inside an entity can be found without enumerating and querying every sub-n-gram. Replaces the live Wikidata
+    lookups of the entity masking notebook.
+
+    The gazetteer is read from a tab-separated file with an English and a Tagalog name on every line,
+    which can be built once from a Wikidata JSON dump with from_wikidata_dump.
+    '''
+
+    # Key under which a trie node stores the translation of the name that ends there
+    END = ""
+
+    def __init__(self, path:str=None):
+        self.trie = {}
+        self.size = 0
+        self.memo = {}
+        if path:
+            self.load(path)
+
+    def add(self, english:str, tagalog:str) -> None:
+        '''
+        Add a name and its translation. The first translation that is added for a name is kept.
+        '''
+        node = self.trie
+        for word in normalize(english).split():
+            node = node.setdefault(word, {})
+        if self.END not in node:
+            node[self.END] = tagalog
+            self.size += 1
+        self.memo.clear()
+
+    def load(self, path:str) -> None:
+        '''
+        Add all names from a (optionally gzipped) tab-separated file with an English and a Tagalog name per line.
+        '''
+        with self.open(path, 'rt') as f:
+            for line in f:
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) == 2 and parts[0] and parts[1]:
+                    self.add(parts[0], parts[1])
+        print("Loaded " + str(self.size) + " place name(s) from " + path)
+
+    def save(self, path:str, pairs:list) -> None:
+        with self.open(path, 'wt') as f:
+            for english, tagalog in pairs:
+                f.write(english + "\t" + tagalog + "\n")
+
+    def open(self, path:str, mode:str):
+        return gzip.open(path, mode, encoding='utf-8') if path.endswith(".gz") else open(path, mode, encoding='utf-8')
+
+    @classmethod
+    def from_wikidata_dump(cls, dump_path:str, out_path:str, src:str='en', tgt:str='tl', places_only:bool=True) -> "Gazetteer":
+        '''
+        Build the gazetteer file from a Wikidata JSON dump (e.g. latest-all.json.gz), which is streamed entity by entity.
+        Every entity with a label in both languages is added, under its source label and its source aliases.
+
+        Args:
+            dump_path: the Wikidata JSON dump, optionally gzipped
+            out_path: the tab-separated gazetteer file to write
+            src: the language code of the source names
+            tgt: the language code of the target names
+            places_only: only keep entities with a coordinate location (P625)
+
+        Returns:
+            Gazetteer: the gazetteer loaded from the new file
+        '''
+        gazetteer = cls()
+        pairs = []
+        with gazetteer.open(dump_path, 'rt') as f:
+            for line in f:
+                line = line.strip().rstrip(",")
+                if not line.startswith("{"):
+                    continue
+                entity = json.loads(line)
+                labels = entity.get("labels", {})
+                if src not in labels or tgt not in labels:
+                    continue
+                if places_only and "P625" not in entity.get("claims", {}):
+                    continue
+
+                translation = labels[tgt]["value"]
+                pairs.append((labels[src]["value"], translation))
+                for alias in entity.get("aliases", {}).get(src, []):
+                    pairs.append((alias["value"], translation))
+
+        gazetteer.save(out_path, pairs)
+        return cls(out_path)
+
+    def lookup(self, words:list) -> str:
+        '''
+        Returns:
+            str: the translation of exactly this sequence of normalized words, or None if it is unknown
+        '''
+        node = self.trie
+        for word in words:
+            node = node.get(word)
+            if node is None:
+                return None
+        return node.get(self.END)
+
+    def longest_match(self, query:str) -> str:
+        '''
+        Find the longest sequence of words inside the query that is a known name (the earliest one if there are several
+        of the same length). This gives the same result as trying every sub-n-gram from long to short.
+
+        Args:
+            query: the entity to translate
+
+        Returns:
+            str: the translation of the longest known name in the query, or None if no part of it is known
+        '''
+        if query in self.memo:
+            return self.memo[query]
+
+        words = normalize(query).split()
+        best = None
+        best_length = 0
+        for start in range(len(words)):
+            node = self.trie
+            for end in range(start, len(words)):
+                node = node.get(words[end])
+                if node is None:
+                    break
+                if self.END in node and end - start + 1 > best_length:
+                    best = node[self.END]
+                    best_length = end - start + 1
+
+        self.memo[query] = best
+        return best
+
+    def translate(self, query:str, recursive:bool=False) -> str:
+        '''
+        Translate an entity. A leading "the" is ignored for the lookup and put back afterwards.
+
+        Args:
+            query: the entity in the source language
+            recursive: whether to fall back to the longest known name inside the entity, instead of only the entity as a whole
+
+        Returns:
+            str: the translation, or the query itself if it is unknown
+        '''
+        prefix = ""
+        if query[0:4] == 'the ':
+            prefix = 'the '
+            query = query[4:]
+
+        if recursive:
+            translation = self.longest_match(query)
+        else:
+            translation = self.lookup(normalize(query).split())
+
+        if translation is None:
+            return prefix + query
+        return prefix + translation
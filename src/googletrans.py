@@ -2,6 +2,8 @@ from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from .googletrans import GoogleTranslate
     
+from .cache import TranslationCache
+from . import instrumentation
 from googletrans import Translator
 from time import sleep
 import tqdm
@@ -9,16 +11,19 @@ from datasets.dataset_dict import DatasetDict
 
 class GoogleTranslate:
     
-    def __init__(self, src_lang="tl", dest_code='en') -> None:
+    def __init__(self, src_lang="tl", dest_code='en', cache:TranslationCache=None) -> None:
         self.translator = Translator()
+        self.cache = cache
         self.src_lang = src_lang
         self.dest_code = dest_code
         self.sleep_in_between_translations_seconds = 1
         self.long_sleep_in_between_translations_seconds = 60
         
+    @instrumentation.timed("googletrans")
     def translate(self, src:list) -> list:
         '''
         Translate the given dataset using Google Translate by translating line by line.
+        If a cache was given, only the lines that were not translated before are sent to Google Translate.
         
         Args:
             src: a list of strings in the source language
@@ -26,7 +31,20 @@ class GoogleTranslate:
         Returns:
             list: a list of the predicted translations in the target language of the source strings
         '''
+        if self.cache is not None:
+            return self.cache.translate(src, self.translate_uncached, self.src_lang, self.dest_code, "googletrans", "web")
+        return self.translate_uncached(src)
+    
+    def translate_uncached(self, src:list) -> list:
+        '''
+        Translate the given lines one by one using Google Translate, without consulting the cache.
         
+        Args:
+            src: a list of strings in the source language
+            
+        Returns:
+            list: a list of the predicted translations in the target language of the source strings
+        '''
         translations = []
         for i in tqdm.tqdm(range(len(src))):
             # print("PROGRESS: " + str(i+1) + "/" + str(len(src)))
@@ -50,8 +68,10 @@ class GoogleTranslate:
     
     def __sleepBetweenQuery(self):
         print('Sleeping for {}s after translation query...'.format(self.sleep_in_between_translations_seconds))
-        sleep(self.sleep_in_between_translations_seconds)
+        with instrumentation.stage("sleep"):
+            sleep(self.sleep_in_between_translations_seconds)
     
     def _longsleepBetweenQuery(self):
         print('LONG SLEEP! Sleeping for {}s after translation query...'.format(self.long_sleep_in_between_translations_seconds))
-        sleep(self.long_sleep_in_between_translations_seconds)
\ No newline at end of file
+        with instrumentation.stage("long_sleep"):
+            sleep(self.long_sleep_in_between_translations_seconds)
\ No newline at end of file
@@ -0,0 +1,148 @@
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .googletrans_stub import StubServer
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import argparse
+import json
+import threading
+import time
+
+class StubServer:
+    '''
+    Local stand-in for the Google Translate web endpoint, used to test AsyncGoogleTranslate without network access.
+    It answers with a fake translation ("EN(<line>)" for every line) and throttles clients that send more than
+    `rate` requests per second with HTTP 429.
+    '''
+
+    def __init__(self, port:int=0, rate:float=10.0, burst:int=5, latency:float=0.05, retry_after:int=None):
+        self.rate = rate
+        self.burst = burst
+        self.latency = latency
+        self.retry_after = retry_after
+
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.served = 0
+        self.throttled = 0
+        self.started = None
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:{}/translate_a/single".format(self.server.server_address[1])
+
+    def start(self) -> "StubServer":
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def allow(self) -> bool:
+        '''
+        Server-side token bucket: whether the current request is within the rate limit.
+        '''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.served += 1
+                return True
+            self.throttled += 1
+            return False
+
+    def stats(self) -> dict:
+        '''
+        Returns:
+            dict: the number of served and throttled requests and the achieved requests/s
+        '''
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        return {'served': self.served, 'throttled': self.throttled, 'elapsed': elapsed,
+                'requests_per_second': self.served / elapsed if elapsed else 0.0}
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/stats":
+                    self.reply(200, stub.stats())
+                else:
+                    self.translate(parse_qs(url.query))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                query = parse_qs(urlparse(self.path).query)
+                query.update(parse_qs(self.rfile.read(length).decode("utf-8")))
+                self.translate(query)
+
+            def translate(self, query:dict):
+                if not stub.allow():
+                    headers = {"Retry-After": str(stub.retry_after)} if stub.retry_after is not None else {}
+                    self.reply(429, {'error': 'Too Many Requests'}, headers)
+                    return
+
+                time.sleep(stub.latency)
+                lines = query.get('q', [""])[0].split("\n")
+                # Same shape as the real response: one [translation, source] segment per sentence
+                segments = [["EN(" + line + ")" + ("\n" if i < len(lines) - 1 else ""), line] for i, line in enumerate(lines)]
+                self.reply(200, [segments, None, query.get('sl', ["auto"])[0]])
+
+            def reply(self, status:int, body, headers:dict={}):
+                content = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+def main():
+    '''
+    Translate a synthetic corpus with AsyncGoogleTranslate against the stub and report the achieved throughput.
+    '''
+    from .asyncgoogletrans import AsyncGoogleTranslate
+
+    parser = argparse.ArgumentParser(description="Run AsyncGoogleTranslate against a local throttling stub server")
+    parser.add_argument("--lines", type=int, default=2000)
+    parser.add_argument("--server-rate", type=float, default=20.0, help="requests/s the stub accepts before answering 429")
+    parser.add_argument("--client-rate", type=float, default=30.0, help="requests/s the client starts with")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--max-lines", type=int, default=32)
+    args = parser.parse_args()
+
+    stub = StubServer(rate=args.server_rate).start()
+    translator = AsyncGoogleTranslate(rate=args.client_rate, concurrency=args.concurrency, max_lines=args.max_lines,
+                                      base_delay=0.1, url=stub.url)
+
+    src = ["Pangungusap bilang {} tungkol sa baha.".format(i) for i in range(args.lines)]
+    start = time.monotonic()
+    translations = translator.translate(src)
+    elapsed = time.monotonic() - start
+    stub.stop()
+
+    assert translations == ["EN(" + line + ")" for line in src]
+    print("Translated {} lines in {:.2f}s ({:.1f} lines/s)".format(len(src), elapsed, len(src) / elapsed))
+    print("Stub server:", stub.stats())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+'''
+Process-wide timing of the pipeline stages: wall time, number of calls, number of tokens and memory per stage,
+so a slow run shows where the time went (tokenization, generate, decoding, COMET, loading data, Google Translate
+sleeps, ...). Stages nest, e.g. "translate/generate" is part of "translate".
+
+Nothing is recorded until enable() is called, and while disabled a stage costs a single check, so the hooks can
+stay in the code. Selected stages can additionally be profiled with cProfile or with a sampling profiler that
+writes collapsed stacks, the format of py-spy --format raw, which flamegraph.pl and speedscope read.
+
+    from src import instrumentation
+    instrumentation.enable(profile="sample", profile_stages=["translate"])
+    ...
+    instrumentation.export("stages.prom")
+'''
+from contextlib import contextmanager, nullcontext
+import cProfile
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+_enabled = False
+_stages = {}
+_active = threading.local()
+_lock = threading.Lock()
+
+# Peak resident memory of every running stage, updated by a background thread while recording is enabled
+_rss_peaks = {}
+_rss_interval = 0.01
+_rss_watcher = None
+
+_profile = None
+_profile_stages = set()
+_profile_dir = "profiles"
+_interval = 0.005
+_profilers = {}
+
+def enable(profile:str=None, profile_stages:list=None, profile_dir:str="profiles", interval:float=0.005) -> None:
+    '''
+    Start recording the stages.
+
+    Args:
+        profile: None, "cprofile" or "sample" to also profile the stages in profile_stages
+        profile_stages: the names of the stages to profile, e.g. ["translate", "finetuning"]
+        profile_dir: the directory to write the profiles to on export
+        interval: the time in seconds between two samples of the sampling profiler
+    '''
+    global _enabled, _profile, _profile_stages, _profile_dir, _interval, _rss_watcher
+    assert profile in (None, "cprofile", "sample"), "profile has to be None, \"cprofile\" or \"sample\""
+    _enabled = True
+    _profile = profile
+    _profile_stages = set(profile_stages or [])
+    _profile_dir = profile_dir
+    _interval = interval
+
+    if _rss_watcher is None or not _rss_watcher.is_alive():
+        _rss_watcher = threading.Thread(target=_watch_rss, daemon=True)
+        _rss_watcher.start()
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+
+def enabled() -> bool:
+    return _enabled
+
+def reset() -> None:
+    with _lock:
+        _stages.clear()
+        _profilers.clear()
+
+class _Stage:
+
+    __slots__ = ("calls", "seconds", "max_seconds", "tokens", "peak_rss_mb", "rss_growth_mb")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.tokens = 0
+        self.peak_rss_mb = 0.0
+        self.rss_growth_mb = 0.0
+
+_page_mb = os.sysconf("SC_PAGE_SIZE") / 2**20 if hasattr(os, "sysconf") else 4096 / 2**20
+
+def _rss_mb() -> float:
+    '''
+    Returns:
+        float: the current resident memory of the process in MB, not the peak over its lifetime like ru_maxrss
+    '''
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _page_mb
+    except OSError:
+        try:
+            import psutil
+            return psutil.Process().memory_info().rss / 2**20
+        except ImportError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _watch_rss() -> None:
+    # Sample the memory while stages run, so memory that is freed again before a stage ends still counts for it
+    while _enabled:
+        if _rss_peaks:
+            rss = _rss_mb()
+            with _lock:
+                for key, peak in _rss_peaks.items():
+                    if rss > peak:
+                        _rss_peaks[key] = rss
+        time.sleep(_rss_interval)
+
+def _path() -> list:
+    if not hasattr(_active, "path"):
+        _active.path = []
+    return _active.path
+
+def _record(name:str) -> _Stage:
+    with _lock:
+        if name not in _stages:
+            _stages[name] = _Stage()
+        return _stages[name]
+
+@contextmanager
+def _timed_stage(name:str):
+    path = _path()
+    path.append(name)
+    full_name = "/".join(path)
+
+    profiler = None
+    if _profile and name in _profile_stages and not getattr(_active, "profiling", False):
+        profiler = _profiler(full_name)
+        _active.profiling = True
+        profiler.start()
+
+    key = object()
+    start_rss = _rss_mb()
+    with _lock:
+        _rss_peaks[key] = start_rss
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if profiler is not None:
+            profiler.stop()
+            _active.profiling = False
+        path.pop()
+
+        end_rss = _rss_mb()
+        stage = _record(full_name)
+        with _lock:
+            peak_rss = max(_rss_peaks.pop(key), end_rss)
+            stage.calls += 1
+            stage.seconds += seconds
+            stage.max_seconds = max(stage.max_seconds, seconds)
+            stage.peak_rss_mb = max(stage.peak_rss_mb, peak_rss)
+            stage.rss_growth_mb = max(stage.rss_growth_mb, peak_rss - start_rss)
+
+# Reused for every stage while disabled, so a disabled stage creates no objects
+_no_stage = nullcontext()
+
+def stage(name:str):
+    '''
+    Context manager that records the time spent in the block as the given stage, nested in the active stages.
+    '''
+    if not _enabled:
+        return _no_stage
+    return _timed_stage(name)
+
+def timed(name:str):
+    '''
+    Decorator that records every call of the function as the given stage.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _timed_stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def add_tokens(count:int, name:str=None) -> None:
+    '''
+    Add to the number of tokens processed by the given stage (relative to the active stages), or else by the active stage.
+    '''
+    if not _enabled:
+        return
+    path = _path()
+    full_name = "/".join(path + [name] if name else path)
+    if not full_name:
+        return
+    stage = _record(full_name)
+    with _lock:
+        stage.tokens += count
+
+class _CProfiler:
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, path:str):
+        self.profile.dump_stats(path + ".prof")
+
+class _Sampler:
+    '''
+    Samples the stack of the thread that runs the stage from a background thread, and counts every distinct stack.
+    '''
+
+    def __init__(self):
+        self.stacks = {}
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self.running = threading.Event()
+        self.running.set()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        while self.running.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append("{} ({}:{})".format(frame.f_code.co_name, os.path.basename(frame.f_code.co_filename), frame.f_lineno))
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            time.sleep(_interval)
+
+    def stop(self):
+        self.running.clear()
+        self.thread.join()
+
+    def write(self, path:str):
+        with open(path + ".folded", "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(stack + " " + str(count) + "\n")
+
+def _profiler(name:str):
+    with _lock:
+        if name not in _profilers:
+            _profilers[name] = _CProfiler() if _profile == "cprofile" else _Sampler()
+        return _profilers[name]
+
+def summary() -> dict:
+    '''
+    Returns:
+        dict: per stage the number of calls, the total and the longest wall time in seconds, the number of tokens,
+            the tokens per second, the highest resident memory of the process in MB while the stage ran, and the largest
+            growth of the resident memory in MB within a single call of the stage
+    '''
+    with _lock:
+        return {name: {
+            "calls": stage.calls,
+            "seconds": stage.seconds,
+            "max_seconds": stage.max_seconds,
+            "tokens": stage.tokens,
+            "tokens_per_second": stage.tokens / stage.seconds if stage.seconds else 0.0,
+            "peak_rss_mb": stage.peak_rss_mb,
+            "rss_growth_mb": stage.rss_growth_mb,
+        } for name, stage in sorted(_stages.items())}
+
+def prometheus() -> str:
+    '''
+    Returns:
+        str: the summary in the Prometheus text format
+    '''
+    metrics = [("calls", "counter", "Number of calls of the stage"),
+               ("seconds", "counter", "Total wall time of the stage in seconds"),
+               ("max_seconds", "gauge", "Longest single call of the stage in seconds"),
+               ("tokens", "counter", "Number of tokens processed in the stage"),
+               ("peak_rss_mb", "gauge", "Highest resident memory of the process while the stage ran in MB"),
+               ("rss_growth_mb", "gauge", "Largest growth of the resident memory within a single call of the stage in MB")]
+    stages = summary()
+    lines = []
+    for metric, kind, description in metrics:
+        # Counters end in _total, following the Prometheus naming conventions
+        name = "pipeline_stage_" + metric + ("_total" if kind == "counter" else "")
+        lines.append("# HELP " + name + " " + description)
+        lines.append("# TYPE " + name + " " + kind)
+        for stage, values in stages.items():
+            lines.append('{}{{stage="{}"}} {}'.format(name, stage.replace('"', '\\"'), values[metric]))
+    return "\n".join(lines) + "\n"
+
+def export(path:str="stages.json") -> None:
+    '''
+    Write the summary, as Prometheus text if the path ends in .prom and as JSON otherwise, and write the profiles.
+    Does nothing if recording was never enabled.
+    '''
+    if not _stages:
+        return
+
+    with open(path, "w") as f:
+        if path.endswith(".prom"):
+            f.write(prometheus())
+        else:
+            json.dump(summary(), f, indent=2)
+
+    if _profilers:
+        os.makedirs(_profile_dir, exist_ok=True)
+        for name, profiler in _profilers.items():
+            profiler.write(os.path.join(_profile_dir, name.replace("/", "_")))
+
+    print("Stage summary written to " + path)
+    for name, values in summary().items():
+        print("  {:40s} {:6d} call(s) {:10.2f}s {:12d} token(s)".format(name, values["calls"], values["seconds"], values["tokens"]))
@@ -0,0 +1,154 @@
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .locations import LocationIndex
+
+from collections import deque
+import os
+import pickle
+import unicodedata
+
+def normalize(text:str) -> str:
+    '''
+    Lowercase the text and remove diacritics, so e.g. "Sagñay" and "SAGNAY" are the same location.
+    '''
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+class AhoCorasick:
+    '''
+    Aho-Corasick automaton that finds all occurrences of many patterns in a text in a single pass.
+    Only matches on word boundaries are reported.
+    '''
+
+    def __init__(self, patterns:list):
+        self.patterns = list(patterns)
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+        for id, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append(id)
+
+        # Breadth-first, so the failure state of every parent is known before its children
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0) if self.goto[fail].get(char, 0) != child else 0
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def search(self, text:str) -> set:
+        '''
+        Returns:
+            set: the ids of the patterns that occur in the text as whole words
+        '''
+        found = set()
+        state = 0
+        for end, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for id in self.output[state]:
+                start = end - len(self.patterns[id]) + 1
+                if (start == 0 or not text[start-1].isalnum()) and (end + 1 == len(text) or not text[end+1].isalnum()):
+                    found.add(id)
+        return found
+
+class LocationIndex:
+    '''
+    The gold locations of the evaluation articles in data/location_pickles, compiled into a single automaton
+    so the output of every system can be checked for all locations in one pass.
+    '''
+
+    categories = ["cities", "municipalities", "provinces", "barangays", "rivers", "bridges", "streets", "buildings", "descriptive"]
+
+    def __init__(self, path:str="data/location_pickles"):
+        self.locations = self.load(path, "locations")
+        self.relevance = self.load(path, "relevance")
+        self.flags = {category: self.load(path, category) for category in self.categories if os.path.exists(os.path.join(path, category + ".pkl"))}
+
+        names = sorted({normalize(name) for article in self.locations for line in article for name in line})
+        self.ids = {name: id for id, name in enumerate(names)}
+        self.automaton = AhoCorasick(names)
+
+    def load(self, path:str, name:str) -> list:
+        with open(os.path.join(path, name + ".pkl"), 'rb') as f:
+            return pickle.load(f)
+
+    def lines(self, prediction) -> list:
+        '''
+        Returns:
+            list: the non-empty lines of a predicted article, given as a string or a list of lines
+        '''
+        if isinstance(prediction, str):
+            prediction = prediction.split("\n")
+        return [line for line in prediction if line.strip() != ""]
+
+    def recall(self, predictions:list) -> dict:
+        '''
+        Computes how many of the gold locations occur in the predicted translations of the evaluation articles,
+        line by line. If the number of lines of an article does not match the gold data, the whole article is searched instead.
+
+        Args:
+            predictions: the predicted translation of every evaluation article, as a string or a list of lines
+
+        Returns:
+            dict: the recall overall, per location category and per relevance flag, and the number of gold locations
+        '''
+        assert len(predictions) == len(self.locations), "expected a prediction for each of the " + str(len(self.locations)) + " articles"
+
+        counts = {}
+        def count(key, found):
+            total, hits = counts.get(key, (0, 0))
+            counts[key] = (total + 1, hits + found)
+
+        for a, prediction in enumerate(predictions):
+            lines = self.lines(prediction)
+            if len(lines) == len(self.locations[a]):
+                matches = [self.automaton.search(normalize(line)) for line in lines]
+            else:
+                matches = [self.automaton.search(normalize("\n".join(lines)))] * len(self.locations[a])
+
+            for l, names in enumerate(self.locations[a]):
+                for n, name in enumerate(names):
+                    found = self.ids[normalize(name)] in matches[l]
+                    count("overall", found)
+                    count("relevance_" + str(self.relevance[a][l][n]), found)
+                    for category, flags in self.flags.items():
+                        if flags[a][l][n]:
+                            count(category, found)
+
+        return {key + "_recall": hits / total for key, (total, hits) in counts.items()} | {"locations": counts.get("overall", (0, 0))[0]}
+
+    def reference_recall(self, predictions:list, references:list) -> float:
+        '''
+        Computes how many of the known locations that occur in a reference also occur in its predicted translation.
+        This needs no alignment with the evaluation articles, so it works on any data, e.g. the validation set during finetuning.
+
+        Args:
+            predictions: the predicted translations
+            references: the reference translations
+
+        Returns:
+            float: the recall of the locations in the references, or None if the references contain no known locations
+        '''
+        total = 0
+        hits = 0
+        for prediction, reference in zip(predictions, references):
+            gold = self.automaton.search(normalize(reference))
+            if gold:
+                total += len(gold)
+                hits += len(gold & self.automaton.search(normalize(prediction)))
+        return hits / total if total else None
@@ -0,0 +1,293 @@
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .masking import Masker
+
+from .gazetteer import Gazetteer
+from itertools import groupby
+from string import punctuation
+import argparse
+import math
+import os
+import random
+import time
+
+class Masker:
+    '''
+    Masks the locations in English text for data augmentation. Locations with a known Tagalog name are replaced by
+    that name, the others by <MASK>. The general mask replaces every location by <MASK>.
+
+    Entities are found with spaCy (GPE and LOC) and translated offline with a Gazetteer.
+    '''
+
+    entity_types = ("GPE", "LOC")
+    mask = "<MASK>"
+
+    def __init__(self, gazetteer:Gazetteer, nlp=None, model:str="en_core_web_md", recursive:bool=False):
+        if nlp is None:
+            import spacy
+            nlp = spacy.load(model)
+        self.nlp = nlp
+        self.gazetteer = gazetteer
+        self.recursive = recursive
+
+    def mask_sentence(self, doc) -> tuple:
+        '''
+        Mask the locations in a single parsed sentence.
+
+        Args:
+            doc: the sentence parsed by spaCy, or the sentence as a string
+
+        Returns:
+            tuple: the masked sentence, the masked entities, their replacements, the number of masked words,
+                the fraction of entities that have a translation, and the generally masked sentence
+        '''
+        if isinstance(doc, str):
+            doc = self.nlp(doc)
+
+        masked_sent = ""
+        general_masked_sent = ""
+        src_translations = []
+        tgt_translations = []
+        sentence_count = 0
+        kb_or_not = []
+
+        # Walk over the tokens and replace every location entity as a whole
+        entities = {ent.start: ent for ent in doc.ents if ent.label_ in self.entity_types}
+        i = 0
+        while i < len(doc):
+            if i in entities:
+                ent = entities[i]
+                kb_trans = self.gazetteer.translate(ent.text, recursive=self.recursive)
+                found = kb_trans != ent.text
+
+                masked_sent += kb_trans if found else self.mask
+                general_masked_sent += self.mask
+
+                # Every masked or translated entity counts as changed, but only translated ones as a hit in the gazetteer
+                src_translations.append(ent.text)
+                tgt_translations.append(kb_trans if found else self.mask)
+                if src_translations[-1] != tgt_translations[-1]:
+                    sentence_count += len(ent.text.split())
+                kb_or_not.append(1 if found else 0)
+
+                whitespace = doc[ent.end - 1].whitespace_
+                i = ent.end
+            else:
+                masked_sent += doc[i].text
+                general_masked_sent += doc[i].text
+                whitespace = doc[i].whitespace_
+                i += 1
+
+            masked_sent += whitespace
+            general_masked_sent += whitespace
+
+        kb_percentage = sum(kb_or_not) / len(kb_or_not) if kb_or_not else 0
+
+        return masked_sent, src_translations, tgt_translations, sentence_count, kb_percentage, general_masked_sent
+
+    def mask_article(self, article:str) -> tuple:
+        '''
+        Mask the locations in an article with one sentence per line.
+
+        Args:
+            article: the article in English
+
+        Returns:
+            tuple: the masked article, the number of masked words, the fraction of masked words, the average fraction of
+                entities that have a translation, and the generally masked article
+        '''
+        return self.mask_docs([self.nlp(sent) for sent in filter(None, article.split("\n"))])
+
+    def mask_docs(self, docs:list) -> tuple:
+        '''
+        Mask the locations in the parsed sentences of a single article, see mask_article.
+        '''
+        masked_article = ""
+        general_masked_article = ""
+        article_count = 0
+        total_count = 0
+        all_kb_percentages = []
+
+        for doc in docs:
+            masked_sent, _, _, sentence_count, kb_percentage, general_masked_sent = self.mask_sentence(doc)
+
+            all_kb_percentages.append(kb_percentage)
+            masked_article += masked_sent + "\n"
+            general_masked_article += general_masked_sent + "\n"
+            article_count += sentence_count
+
+            # Entities are not merged, so the parse that found them also gives the token count
+            total_count += len(doc)
+
+        article_percentage = article_count / total_count if total_count else 0
+        kb_article_percentage = sum(all_kb_percentages) / len(all_kb_percentages) if all_kb_percentages else 0
+
+        return masked_article, article_count, article_percentage, kb_article_percentage, general_masked_article
+
+
+class MaskingPipeline:
+    '''
+    Builds the masked training sets (MODEL4/5/6 in the notebooks) from the finetuning articles. All sentences are streamed
+    through spaCy's nlp.pipe in batches, optionally over several processes, every sentence is parsed exactly once, and
+    the output files are written article by article.
+
+    Articles of which less than min_percentage of the tokens were masked get random proper words masked instead,
+    about 1% of their tokens.
+    '''
+
+    def __init__(self, masker:Masker, batch_size:int=256, n_process:int=1, min_percentage:float=0.01, seed:int=0):
+        self.masker = masker
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.min_percentage = min_percentage
+        self.random = random.Random(seed)
+        self.stopwords = self.load_stopwords()
+
+    def load_stopwords(self) -> set:
+        try:
+            from nltk.corpus import stopwords
+            return set(stopwords.words('english'))
+        except (ImportError, LookupError):
+            return set(self.masker.nlp.Defaults.stop_words)
+
+    def mask_articles(self, articles:list):
+        '''
+        Mask a list of articles with one sentence per line.
+
+        Args:
+            articles: the articles in English
+
+        Yields:
+            tuple: for every article in order, the masked article, the number of masked words, the fraction of masked words,
+                the average fraction of entities that have a translation, the generally masked article, and whether
+                the article was masked randomly because too few locations were found
+        '''
+        sentences = ((sent, i) for i, article in enumerate(articles) for sent in filter(None, article.split("\n")))
+        docs = self.masker.nlp.pipe(sentences, as_tuples=True, batch_size=self.batch_size, n_process=self.n_process)
+
+        next_article = 0
+        for i, group in groupby(docs, key=lambda doc_and_index: doc_and_index[1]):
+            # Articles without any sentence do not show up in the stream
+            for _ in range(next_article, i):
+                yield "", 0, 0, 0, "", False
+            next_article = i + 1
+
+            yield self.mask_article(list(doc for doc, _ in group))
+
+        for _ in range(next_article, len(articles)):
+            yield "", 0, 0, 0, "", False
+
+    def mask_article(self, docs:list) -> tuple:
+        masked_article, article_count, article_percentage, kb_article_percentage, general_masked_article = self.masker.mask_docs(docs)
+
+        if article_percentage >= self.min_percentage:
+            return masked_article, article_count, article_percentage, kb_article_percentage, general_masked_article, False
+
+        masked_article = self.mask_random(docs)
+        return masked_article, article_count, article_percentage, kb_article_percentage, masked_article, True
+
+    def mask_random(self, docs:list) -> str:
+        '''
+        Mask about 1% of the tokens of an article, picking only words that are not punctuation, numbers or stopwords.
+
+        Args:
+            docs: the parsed sentences of the article
+
+        Returns:
+            str: the masked article
+        '''
+        tokens = [token for doc in docs for token in doc]
+        candidates = [i for i, token in enumerate(tokens)
+                      if not any(c in punctuation for c in token.text) and not token.text.isdigit()
+                      and token.text not in self.stopwords and token.text.strip() != ""]
+        masked = set(self.random.sample(candidates, min(len(candidates), math.ceil(len(tokens) / 100))))
+
+        masked_article = ""
+        i = 0
+        for doc in docs:
+            for token in doc:
+                masked_article += (self.masker.mask if i in masked else token.text) + token.whitespace_
+                i += 1
+            masked_article += "\n"
+        return masked_article
+
+    def build(self, excel_path:str, out_dir:str=".", name:str="Finetuning flooding data", test_size:float=0.1) -> dict:
+        '''
+        Write the training files of the masked models:
+        - MODEL4: the English articles and their masked versions (larger part of the articles)
+        - MODEL5: the English articles and their Tagalog translations (smaller part of the articles)
+        - MODEL6: the English articles and their generally masked versions (the same articles as MODEL4)
+
+        Args:
+            excel_path: the finetuning data, with an "English" and a "Tagalog" column
+            out_dir: the directory to write the files to
+            name: the prefix of the file names
+            test_size: the fraction of the articles for the parallel MODEL5 set
+
+        Returns:
+            dict: statistics of the masking
+        '''
+        import pandas as pd
+
+        excel = pd.read_excel(excel_path)
+        english = [article if isinstance(article, str) else "" for article in excel["English"]]
+        tagalog = [article if isinstance(article, str) else "" for article in excel["Tagalog"]]
+
+        # Same split for every run with the same seed
+        indices = list(range(len(english)))
+        self.random.shuffle(indices)
+        parallel = set(indices[:math.ceil(len(indices) * test_size)])
+
+        os.makedirs(out_dir, exist_ok=True)
+        paths = {key: os.path.join(out_dir, name + " " + key + ".txt")
+                 for key in ["MODEL4 EN", "MODEL4 EN masked", "MODEL5 EN", "MODEL5 TL", "MODEL6 EN", "MODEL6 EN masked"]}
+        files = {key: open(path, 'w') for key, path in paths.items()}
+
+        start = time.perf_counter()
+        stats = {'articles': 0, 'masked_words': 0, 'masked_percentage': 0.0, 'kb_percentage': 0.0, 'randomly_masked': 0}
+        try:
+            for i, (masked, count, percentage, kb_percentage, general_masked, random_mask) in enumerate(self.mask_articles(english)):
+                if i in parallel:
+                    files["MODEL5 EN"].write(english[i] + "\n")
+                    files["MODEL5 TL"].write(tagalog[i] + "\n")
+                else:
+                    files["MODEL4 EN"].write(english[i] + "\n")
+                    files["MODEL4 EN masked"].write(masked + "\n")
+                    files["MODEL6 EN"].write(english[i] + "\n")
+                    files["MODEL6 EN masked"].write(general_masked + "\n")
+
+                stats['articles'] += 1
+                stats['masked_words'] += count
+                stats['masked_percentage'] += percentage
+                stats['kb_percentage'] += kb_percentage
+                stats['randomly_masked'] += random_mask
+        finally:
+            for f in files.values():
+                f.close()
+
+        if stats['articles']:
+            stats['masked_percentage'] /= stats['articles']
+            stats['kb_percentage'] /= stats['articles']
+        stats['seconds'] = time.perf_counter() - start
+
+        print("Masked {articles} article(s) in {seconds:.1f}s: {masked_words} masked word(s), {masked_percentage:.2%} masked on average, "
+              "{kb_percentage:.2%} of the locations found in the gazetteer, {randomly_masked} article(s) masked randomly".format(**stats))
+        return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the masked training sets from the finetuning articles")
+    parser.add_argument("--input", default="data/Finetuning flooding data tg-en.xlsx", help="Excel file with English and Tagalog columns")
+    parser.add_argument("--gazetteer", required=True, help="tab-separated English/Tagalog place name file")
+    parser.add_argument("--out-dir", default=".")
+    parser.add_argument("--model", default="en_core_web_md", help="the spaCy model")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--n-process", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    masker = Masker(Gazetteer(args.gazetteer), model=args.model)
+    pipeline = MaskingPipeline(masker, batch_size=args.batch_size, n_process=args.n_process, seed=args.seed)
+    pipeline.build(args.input, args.out_dir)
+
+if __name__ == '__main__':
+    main()
@@ -3,64 +3,447 @@ if TYPE_CHECKING:
     from .nllbtranslator import NLLBTranslator
     
 from .evaluation import Evaluation
-from transformers import NllbTokenizer, AutoModelForSeq2SeqLM, DataCollatorForSeq2Seq, AdamWeightDecay, Seq2SeqTrainingArguments, Seq2SeqTrainer
+from .cache import TranslationCache, model_fingerprint
+from .training import tokenize_function, tokenized_dataset, ThroughputCallback, FinetuningTrainer
+from . import registry
+from . import instrumentation
+from functools import cached_property
+import json
+import os
+import re
+import resource
+import shutil
+import time
+import multiprocessing
+import torch
+import tqdm
+from transformers import AutoModelForSeq2SeqLM, GenerationConfig, DataCollatorForSeq2Seq, AdamWeightDecay, Seq2SeqTrainingArguments
 from datasets.dataset_dict import DatasetDict
 
+def _translate_peak_rss_mb(src:str, tgt:str, version:str, finetuned:bool, engine:str, batch_size:int, max_tokens:int, sources:list) -> float:
+    translator = NLLBTranslator(src, tgt, version, finetuned=finetuned, batch_size=batch_size, max_tokens=max_tokens, engine=engine)
+    translator.translate_uncached(sources, progress=False)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
 class NLLBTranslator:
     
-    def __init__(self, src:str, tgt:str, version:str, finetuned:bool=False):
+    def __init__(self, src:str, tgt:str, version:str, finetuned:bool=False, batch_size:int=16, max_tokens:int=None, cache:TranslationCache=None, engine:str="torch"):
         self.src = src
         self.tgt = tgt
         self.version = version
+        self.finetuned = finetuned
+        self.engine = engine
+        
+        # Maximum number of sentences per generate call, and optionally the maximum number of
+        # (padded) source tokens per batch. Whichever limit is hit first closes the batch.
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
         
-        self.tokenizer = NllbTokenizer.from_pretrained("facebook/nllb-200-distilled-600M", src_lang=src, tgt_lang=tgt)
+        # Shared with other translators and Evaluation instances, so they are only loaded once per process
+        self.tokenizer = registry.tokenizer(self.tokenizer_path(version, finetuned), src_lang=src, tgt_lang=tgt)
+        self.model = registry.model(self.model_path(version, finetuned), engine)
         
-        if finetuned:
-            self.model = AutoModelForSeq2SeqLM.from_pretrained("finetuned_"+ version +"/")
-        else:
-            self.model = AutoModelForSeq2SeqLM.from_pretrained("facebook/nllb-200-distilled-600M")
+        # Translations are only reused for exactly the same weights, engine and generation settings
+        self.cache = cache
+        if cache is not None:
+            self.model_id = self.identity(version, finetuned, engine)
         
         # self.checkpoint = "t5-small"
         self.checkpoint = "v3"
         # self.data_collator = DataCollatorForSeq2Seq(tokenizer=self.tokenizer, model=self.checkpoint, return_tensors="tf")
         self.data_collator = DataCollatorForSeq2Seq(tokenizer=self.tokenizer, model=self.checkpoint, return_tensors="pt")
+    
+    # AdamWeightDecay needs TensorFlow, so it is only created when it is used
+    @cached_property
+    def optimizer(self):
+        return AdamWeightDecay(learning_rate=2e-5, weight_decay_rate=0.01)
         
-        self.optimizer = AdamWeightDecay(learning_rate=2e-5, weight_decay_rate=0.01)
+    @staticmethod
+    def model_path(version:str, finetuned:bool=False) -> str:
+        """
+        Returns:
+            str: the directory of the finetuned checkpoint, or the name of the base model
+        """
+        return "finetuned_"+ version +"/" if finetuned else registry.BASE_MODEL
+    
+    # Written by VocabularyTrimmer next to a checkpoint with its own, trimmed vocabulary
+    trimmed_marker = "trimmed_vocabulary.json"
+    
+    @staticmethod
+    def tokenizer_path(version:str, finetuned:bool=False) -> str:
+        """
+        Returns:
+            str: the directory of the finetuned checkpoint if it has a trimmed vocabulary, or the name of the base model.
+                Other finetuned checkpoints share the tokenizer of the base model, even though the trainer saves a copy with them.
+        """
+        path = NLLBTranslator.model_path(version, finetuned)
+        return path if finetuned and os.path.isfile(os.path.join(path, NLLBTranslator.trimmed_marker)) else registry.BASE_MODEL
+    
+    @staticmethod
+    def load_model(path:str, engine:str="torch"):
+        """
+        Load the translation model with the given inference engine.
         
-    def translate(self, src:list) -> list:
+        Args:
+            path: the directory of the finetuned checkpoint, or the name of the base model
+            engine: "torch" for the fp32 PyTorch model, "int8" for the PyTorch model with dynamically quantized
+                linear layers, or "onnx" for an ONNX Runtime encoder/decoder with KV-cache
+            
+        Returns:
+            the model, which can be used with generate
+        """
+        if engine == "torch":
+            return AutoModelForSeq2SeqLM.from_pretrained(path)
+        
+        if engine == "int8":
+            model = AutoModelForSeq2SeqLM.from_pretrained(path)
+            return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        
+        if engine == "onnx":
+            try:
+                from optimum.onnxruntime import ORTModelForSeq2SeqLM
+            except ImportError:
+                raise ImportError("The onnx engine needs optimum and onnxruntime: pip install optimum[onnxruntime]")
+            
+            # The exported model is stored next to the checkpoint with the fingerprint of the weights it was exported from,
+            # so it is only exported again when the checkpoint changes, e.g. after finetuning or trimming it again
+            onnx_path = "onnx_" + path.strip("/").replace("/", "_") + "/"
+            fingerprint_path = os.path.join(onnx_path, "fingerprint.txt")
+            fingerprint = model_fingerprint(path) if os.path.isdir(path) else path
+            if os.path.isfile(fingerprint_path):
+                with open(fingerprint_path) as f:
+                    if f.read() == fingerprint:
+                        return ORTModelForSeq2SeqLM.from_pretrained(onnx_path, use_cache=True)
+            
+            shutil.rmtree(onnx_path, ignore_errors=True)
+            model = ORTModelForSeq2SeqLM.from_pretrained(path, export=True, use_cache=True)
+            model.save_pretrained(onnx_path)
+            with open(fingerprint_path, "w") as f:
+                f.write(fingerprint)
+            return model
+        
+        raise ValueError("Unknown engine '" + engine + "', use 'torch', 'int8' or 'onnx'")
+    
+    @staticmethod
+    def identity(version:str, finetuned:bool=False, engine:str="torch") -> str:
         """
-        Generate string in the target language given the string in the source language.
+        Identify the model weights, engine and generation settings, so cached translations are only reused for the same model.
+        
+        Args:
+            version: which version of the finetuned model to use
+            finetuned: bool whether to use the finetuned version of the model or not
+            engine: the inference engine the model runs on
+            
+        Returns:
+            str: the base model name or checkpoint hash, followed by the engine and generation settings
+        """
+        path = NLLBTranslator.model_path(version, finetuned)
+        weights = model_fingerprint(path) if finetuned else path
+        try:
+            generation_config = GenerationConfig.from_pretrained(path)
+        except OSError:
+            generation_config = GenerationConfig()
+        return weights + ("" if engine == "torch" else ":" + engine) + json.dumps(generation_config.to_diff_dict(), sort_keys=True)
+    
+    def parity_check(self, sources:list, labels:list, eval_class:Evaluation, sample_size:int=200, measure_memory:bool=True) -> dict:
+        """
+        Compare the translation quality, speed and resident memory of this engine with the fp32 PyTorch model on a sample of the data.
+        
+        Args:
+            sources: the text in the source language
+            labels: the text in the target language
+            eval_class: instance of the Evaluation class
+            sample_size: the number of sentences to compare on
+            measure_memory: whether to measure the peak resident memory of every engine, see peak_rss_mb
+            
+        Returns:
+            dict: the scores, translation time and peak resident memory of both engines, and the BLEU and COMET delta
+                and the memory ratio of this engine against fp32
+        """
+        sources = sources[:sample_size]
+        labels = labels[:sample_size]
+        reference = NLLBTranslator(self.src, self.tgt, self.version, finetuned=self.finetuned, batch_size=self.batch_size, max_tokens=self.max_tokens)
+        
+        report = {}
+        for name, translator in [("fp32", reference), (self.engine, self)]:
+            # Warm up, so one-time initialisation is not part of the timing
+            translator.translate_uncached(sources[:1], progress=False)
+            
+            start = time.perf_counter()
+            predictions = translator.translate_uncached(sources)
+            seconds = time.perf_counter() - start
+            
+            score = eval_class.eval(predictions, labels, sources)
+            report[name] = {'bleu': score['bleu']['score'], 'comet': score['comet']['mean_score'], 'seconds': seconds}
+            if measure_memory:
+                report[name]['peak_rss_mb'] = self.peak_rss_mb(translator.engine, sources)
+        
+        report['bleu_delta'] = report[self.engine]['bleu'] - report["fp32"]['bleu']
+        report['comet_delta'] = report[self.engine]['comet'] - report["fp32"]['comet']
+        report['speedup'] = report["fp32"]['seconds'] / report[self.engine]['seconds']
+        memory = ""
+        if measure_memory:
+            report['memory_ratio'] = report[self.engine]['peak_rss_mb'] / report["fp32"]['peak_rss_mb']
+            memory = ", peak RSS {:.0f} MB vs {:.0f} MB".format(report[self.engine]['peak_rss_mb'], report["fp32"]['peak_rss_mb'])
+        
+        print("Engine " + self.engine + " vs fp32 on " + str(len(sources)) + " sentence(s): BLEU delta {:.2f}, COMET delta {:.4f}, speedup {:.2f}x".format(
+            report['bleu_delta'], report['comet_delta'], report['speedup']) + memory)
+        return report
+    
+    def peak_rss_mb(self, engine:str, sources:list) -> float:
+        """
+        Load the model with the given engine in a fresh process and translate the sentences there. The engines of this
+        process share one address space, so their memory can only be told apart in separate processes.
+        
+        Returns:
+            float: the peak resident memory of that process in MB
+        """
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(1) as pool:
+            return pool.apply(_translate_peak_rss_mb, (self.src, self.tgt, self.version, self.finetuned, engine, self.batch_size, self.max_tokens, sources))
+    
+    @instrumentation.timed("translate")
+    def translate(self, src:list, batch_size:int=None, max_tokens:int=None) -> list:
+        """
+        Generate strings in the target language given strings in the source language.
+        The sentences are sorted by length and translated in batches, so every batch is only padded
+        as far as its longest sentence. The translations are returned in the original order.
+        If a cache was given, only the sentences that were not translated before are sent to the model.
+        
+        Args:
+            src: list of strings in the source language (a single string is also accepted)
+            batch_size: maximum number of sentences per batch, defaults to the one given to the constructor
+            max_tokens: maximum number of padded source tokens per batch, defaults to the one given to the constructor
+            
+        Returns:
+            list: the predicted translations in the target language (a string if a single string was given)
+        """
+        if isinstance(src, str):
+            return self.translate([src], batch_size=batch_size, max_tokens=max_tokens)[0]
+        
+        if self.cache is not None:
+            return self.cache.translate(src, lambda missing: self.translate_uncached(missing, batch_size, max_tokens),
+                                        self.src, self.tgt, "nllb", self.model_id)
+        return self.translate_uncached(src, batch_size, max_tokens)
+    
+    def translate_uncached(self, src:list, batch_size:int=None, max_tokens:int=None, progress:bool=True) -> list:
+        """
+        Translate a list of sentences in length-bucketed batches, without consulting the cache.
         
         Args:
             src: list of strings in the source language
+            batch_size: maximum number of sentences per batch, defaults to the one given to the constructor
+            max_tokens: maximum number of padded source tokens per batch, defaults to the one given to the constructor
+            progress: whether to show a progress bar
             
         Returns:
             list: the predicted translations in the target language
         """
-
-        inputs = self.tokenizer(src, return_tensors="pt")
+        translations = [None] * len(src)
+        batches = self.length_buckets(src, batch_size or self.batch_size, max_tokens or self.max_tokens)
         
-        translated_tokens = self.model.generate(
-            **inputs, forced_bos_token_id=self.tokenizer.lang_code_to_id[self.tgt]
-        )
+        for batch in tqdm.tqdm(batches, disable=not progress or len(batches) < 2):
+            decoded = self.generate([src[i] for i in batch])
+            for i, translation in zip(batch, decoded):
+                translations[i] = translation
+        
+        return translations
+    
+    def translate_articles(self, articles:list, max_chunk_tokens:int=128, batch_size:int=None, max_tokens:int=None) -> list:
+        """
+        Translate whole articles with newline-separated sentences. Every line is split into chunks of at most
+        max_chunk_tokens tokens, the chunks of all articles are translated together in length-bucketed batches,
+        and every article is put back together with its original line structure.
+        
+        Args:
+            articles: list of articles in the source language, with one sentence or paragraph per line
+            max_chunk_tokens: maximum number of tokens in a single chunk
+            batch_size: maximum number of chunks per batch, defaults to the one given to the constructor
+            max_tokens: maximum number of padded source tokens per batch, defaults to the one given to the constructor
+            
+        Returns:
+            list: the translated articles, with the same number of lines as the originals
+        """
+        chunks = []
+        layout = []
+        for article in articles:
+            lines = []
+            for line in article.split("\n"):
+                ids = []
+                if line.strip() != "":
+                    for chunk in self.split_line(line, max_chunk_tokens):
+                        ids.append(len(chunks))
+                        chunks.append(chunk)
+                lines.append(ids)
+            layout.append(lines)
+        
+        print("Translating " + str(len(articles)) + " article(s) in " + str(len(chunks)) + " chunk(s)")
+        translated = self.translate(chunks, batch_size=batch_size, max_tokens=max_tokens)
+        
+        return ["\n".join(" ".join(translated[i] for i in ids) for ids in lines) for lines in layout]
+    
+    def split_line(self, line:str, max_chunk_tokens:int) -> list:
+        """
+        Split a single line into chunks of at most max_chunk_tokens tokens. The line is split on sentence
+        boundaries first, and sentences that are still too long are split between words.
+        
+        Args:
+            line: a line in the source language
+            max_chunk_tokens: maximum number of tokens in a single chunk
+            
+        Returns:
+            list: the chunks, which together make up the line
+        """
+        sentences = [sentence for sentence in re.split(r"(?<=[.!?])\s+", line.strip()) if sentence]
+        lengths = [len(ids) for ids in self.tokenizer(sentences, add_special_tokens=False)["input_ids"]]
+        if sum(lengths) <= max_chunk_tokens:
+            return [line.strip()]
+        
+        chunks = []
+        chunk = []
+        chunk_length = 0
+        for sentence, length in zip(sentences, lengths):
+            if length > max_chunk_tokens:
+                pieces = self.split_words(sentence, max_chunk_tokens)
+            else:
+                pieces = [(sentence, length)]
+            
+            for piece, piece_length in pieces:
+                if chunk and chunk_length + piece_length > max_chunk_tokens:
+                    chunks.append(" ".join(chunk))
+                    chunk = []
+                    chunk_length = 0
+                chunk.append(piece)
+                chunk_length += piece_length
+        if chunk:
+            chunks.append(" ".join(chunk))
+        
+        return chunks
+    
+    def split_words(self, sentence:str, max_chunk_tokens:int) -> list:
+        """
+        Split a sentence that is too long for a single chunk between words.
+        
+        Args:
+            sentence: a sentence in the source language
+            max_chunk_tokens: maximum number of tokens in a single chunk
+            
+        Returns:
+            list: tuples of the pieces and their number of tokens
+        """
+        words = sentence.split()
+        lengths = [len(ids) for ids in self.tokenizer(words, add_special_tokens=False)["input_ids"]]
         
-        translation = self.tokenizer.batch_decode(translated_tokens, skip_special_tokens=True)[0]
+        pieces = []
+        piece = []
+        piece_length = 0
+        for word, length in zip(words, lengths):
+            if piece and piece_length + length > max_chunk_tokens:
+                pieces.append((" ".join(piece), piece_length))
+                piece = []
+                piece_length = 0
+            piece.append(word)
+            piece_length += length
+        if piece:
+            pieces.append((" ".join(piece), piece_length))
         
-        return translation
+        return pieces
     
-    def finetuning(self, parallel:DatasetDict, eval_class:Evaluation) -> None:
+    def generate(self, src:list) -> list:
+        """
+        Translate a single batch of sentences with one call to generate.
+        
+        Args:
+            src: list of strings in the source language
+            
+        Returns:
+            list: the predicted translations in the target language, in the same order
+        """
+        with instrumentation.stage("tokenize"):
+            inputs = self.tokenizer(src, return_tensors="pt", padding=True)
+            if instrumentation.enabled():
+                instrumentation.add_tokens(int(inputs["attention_mask"].sum()))
+        
+        with instrumentation.stage("generate"), torch.inference_mode():
+            translated_tokens = self.model.generate(
+                **inputs, forced_bos_token_id=self.tokenizer.convert_tokens_to_ids(self.tgt)
+            )
+            if instrumentation.enabled():
+                instrumentation.add_tokens(int((translated_tokens != self.tokenizer.pad_token_id).sum()))
+        
+        with instrumentation.stage("decode"):
+            return self.tokenizer.batch_decode(translated_tokens, skip_special_tokens=True)
+    
+    def length_buckets(self, src:list, batch_size:int, max_tokens:int=None) -> list:
+        """
+        Group sentences of similar length into batches.
+        
+        Args:
+            src: list of strings in the source language
+            batch_size: maximum number of sentences per batch
+            max_tokens: maximum number of padded source tokens per batch
+            
+        Returns:
+            list: lists of indices into src, one list per batch
+        """
+        lengths = [len(ids) for ids in self.tokenizer(src)["input_ids"]] if src else []
+        order = sorted(range(len(src)), key=lambda i: lengths[i])
+        
+        batches = []
+        batch = []
+        for i in order:
+            # Sorted by length, so the current sentence is always the longest one in the batch
+            too_many_tokens = max_tokens is not None and (len(batch) + 1) * lengths[i] > max_tokens
+            if batch and (len(batch) == batch_size or too_many_tokens):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        
+        return batches
+    
+    @instrumentation.timed("finetuning")
+    def finetuning(self, parallel:DatasetDict, eval_class:Evaluation, batch_size:int=8, gradient_accumulation_steps:int=1,
+                   gradient_checkpointing:bool=False, group_by_length:bool=False, max_tokens:int=None, max_length:int=128,
+                   num_proc:int=None, tokenized_cache:str="tokenized", num_train_epochs:int=1, fast_eval:bool=False,
+                   eval_samples:int=200, eval_max_new_tokens:int=64, eval_loss_only:bool=False, full_eval_every:int=None) -> None:
         '''
         Finetunes the NLLB translation model given a certain dataset.
         
+        The defaults train like before. For larger effective batches in the same memory, combine a smaller batch_size with
+        gradient_accumulation_steps, turn on gradient_checkpointing (recomputes activations in the backward pass), and
+        group_by_length or max_tokens to cut down on padding.
+        
+        With fast_eval, the validation after every epoch only covers a fixed subsample and decodes greedily (or only computes
+        the loss), and the whole validation set is evaluated every full_eval_every evaluations and once after training.
+        
         Args:
             parallel: the parallel dataset containing the text in source and target language
             eval_class: instance of the Evaluation class
+            batch_size: the number of examples per step, unless max_tokens is given
+            gradient_accumulation_steps: the number of steps to accumulate the gradients of before every update
+            gradient_checkpointing: trade compute for memory by not keeping all activations
+            group_by_length: put examples of similar length in the same batch
+            max_tokens: batch the training data by at most this many tokens (including padding) instead of by batch_size
+            max_length: the maximum number of tokens of the source and the target
+            num_proc: the number of processes to tokenize with, one per CPU if None
+            tokenized_cache: the directory to cache the tokenized datasets in
+            num_train_epochs: the number of epochs to train
+            fast_eval: validate cheaply during training, see FinetuningTrainer
+            eval_samples: the size of the validation subsample with fast_eval
+            eval_max_new_tokens: the maximum number of generated tokens with fast_eval
+            eval_loss_only: only compute the validation loss and perplexity with fast_eval, without generating
+            full_eval_every: with fast_eval, evaluate the whole validation set every this many evaluations
         '''
-            
-        tokenized = parallel.map(function=self.preprocess_function, batched=True)
+        # The weights are about to change, so translators created later should not get this model from the registry
+        registry.forget_model(self.model_path(self.version, self.finetuned), self.engine)
         
-        batch_size = 8
-        # Problem seems to be RAM??? maybe better after the other thing is done running
+        # A trimmed model has its own vocabulary, so the predictions have to be decoded with its tokenizer
+        eval_class.tokenizer = self.tokenizer
+            
+        with instrumentation.stage("tokenize"):
+            tokenized = tokenized_dataset(parallel, self.tokenizer, max_length=max_length, num_proc=num_proc, cache_dir=tokenized_cache)
         
         model_name = self.checkpoint.split("/")[-1]
         
@@ -70,29 +453,46 @@ class NLLBTranslator:
             learning_rate=2e-5,
             per_device_train_batch_size=batch_size,
             per_device_eval_batch_size=batch_size,
+            gradient_accumulation_steps=gradient_accumulation_steps,
+            gradient_checkpointing=gradient_checkpointing,
+            group_by_length=group_by_length,
             weight_decay=0.01,
             save_total_limit=3,
-            num_train_epochs=1,
+            num_train_epochs=num_train_epochs,
             predict_with_generate=True
         )
         
         data_collator = DataCollatorForSeq2Seq(self.tokenizer, model=self.model)
+        throughput = ThroughputCallback(sum(tokenized["train"]["length"]), len(tokenized["train"]))
         
-        trainer = Seq2SeqTrainer(
+        trainer = FinetuningTrainer(
             self.model,
             args,
             train_dataset=tokenized["train"],
             eval_dataset=tokenized["valid"],
             data_collator=data_collator,
             tokenizer=self.tokenizer,
-            compute_metrics=eval_class.compute_metrics
+            compute_metrics=eval_class.compute_metrics,
+            callbacks=[throughput],
+            max_tokens=max_tokens,
+            fast_eval=fast_eval,
+            eval_samples=eval_samples,
+            eval_max_new_tokens=eval_max_new_tokens,
+            eval_loss_only=eval_loss_only,
+            full_eval_every=full_eval_every
         )
         
         print("START TRAINING...")
-        trainer.train()
+        with instrumentation.stage("train"):
+            trainer.train()
+            instrumentation.add_tokens(throughput.tokens * num_train_epochs)
         print("TRAINING DONE")
+        
+        if fast_eval and not trainer.last_eval_full:
+            print(trainer.full_evaluate())
 
         trainer.save_model("finetuned_"+ self.version + "/")
+        registry.forget_model("finetuned_"+ self.version + "/")
     
     def preprocess_function(self, examples:DatasetDict) -> DatasetDict:
         '''
@@ -104,13 +504,4 @@ class NLLBTranslator:
         Returns:
             DatasetDict: the tokenized and preprocessed dataset
         '''
-        source_lang = "tg"
-        target_lang = "en"
-        prefix = "translate Tagalog to English: "
-        
-        inputs = [prefix + example[source_lang] for example in examples["translation"]]
-        targets = [example[target_lang] for example in examples["translation"]]
-        
-        model_inputs = self.tokenizer(inputs, text_target=targets, max_length=128, truncation=True)
-        
-        return model_inputs
\ No newline at end of file
+        return tokenize_function(examples, self.tokenizer)
@@ -0,0 +1,129 @@
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .pool import TranslationPool
+
+from .nllbtranslator import NLLBTranslator
+from .cache import TranslationCache
+import multiprocessing
+import os
+import time
+import torch
+import tqdm
+
+# The translator of the current worker process, loaded once by _init_worker
+_translator = None
+
+def _init_worker(src:str, tgt:str, version:str, finetuned:bool, threads:int, batch_size:int, max_tokens:int, engine:str) -> None:
+    global _translator
+    torch.set_num_threads(threads)
+    _translator = NLLBTranslator(src=src, tgt=tgt, version=version, finetuned=finetuned, batch_size=batch_size, max_tokens=max_tokens, engine=engine)
+
+def _translate_shard(shard:list) -> list:
+    return _translator.translate_uncached(shard, progress=False)
+
+def _translate_articles(articles:list) -> list:
+    return _translator.translate_articles(articles)
+
+class TranslationPool:
+    '''
+    Translates with several NLLBTranslator worker processes at once. Every worker loads the tokenizer and model once
+    and uses its own number of torch threads. The input is cut into small shards which idle workers pick up one by one,
+    and the translations are streamed back in the original order.
+    '''
+
+    def __init__(self, src:str, tgt:str, version:str, finetuned:bool=False, workers:int=None, threads_per_worker:int=None,
+                 batch_size:int=16, max_tokens:int=None, shard_size:int=64, cache:TranslationCache=None, engine:str="torch", start_method:str="spawn"):
+        self.src = src
+        self.tgt = tgt
+        self.workers = workers or os.cpu_count()
+        self.threads_per_worker = threads_per_worker or max(1, os.cpu_count() // self.workers)
+        self.shard_size = shard_size
+        self.cache = cache
+        self.model_id = None
+
+        context = multiprocessing.get_context(start_method)
+        self.pool = context.Pool(self.workers, initializer=_init_worker,
+                                 initargs=(src, tgt, version, finetuned, self.threads_per_worker, batch_size, max_tokens, engine))
+
+        if cache is not None:
+            # Use the same cache keys as a single NLLBTranslator would
+            self.model_id = NLLBTranslator.identity(version, finetuned, engine)
+
+    def __enter__(self) -> "TranslationPool":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.pool.close()
+        self.pool.join()
+
+    def imap(self, src:list, articles:bool=False):
+        '''
+        Translate the given sentences and yield the translations one by one in the original order, as soon as they are done.
+
+        Args:
+            src: list of strings in the source language
+            articles: whether src holds whole articles, which every worker translates with translate_articles, one article per task
+
+        Yields:
+            str: the predicted translation of every sentence or article
+        '''
+        shard_size = 1 if articles else self.shard_size
+        shards = [src[i:i+shard_size] for i in range(0, len(src), shard_size)]
+        for translations in self.pool.imap(_translate_articles if articles else _translate_shard, shards):
+            yield from translations
+
+    def translate(self, src:list, articles:bool=False) -> list:
+        '''
+        Translate the given sentences with all workers.
+        If a cache was given, only the sentences that were not translated before are sent to the workers.
+
+        Args:
+            src: list of strings in the source language
+            articles: whether src holds whole articles, see imap
+
+        Returns:
+            list: the predicted translations in the target language
+        '''
+        if self.cache is not None:
+            return self.cache.translate(src, lambda missing: self.translate_uncached(missing, articles), self.src, self.tgt,
+                                        "nllb-articles" if articles else "nllb", self.model_id)
+        return self.translate_uncached(src, articles)
+
+    def translate_uncached(self, src:list, articles:bool=False) -> list:
+        return list(tqdm.tqdm(self.imap(src, articles), total=len(src)))
+
+def scaling_curve(src:list, version:str, finetuned:bool=False, max_workers:int=None, **kwargs) -> list:
+    '''
+    Measure the translation throughput with 1 up to max_workers worker processes, each using its share of the CPU cores.
+    Model loading is not included in the timings.
+
+    Args:
+        src: list of strings in the source language to translate
+        version: which version of the finetuned model to use
+        finetuned: bool whether to use the finetuned version of the model or not
+        max_workers: the largest number of workers to measure, defaults to the number of CPU cores
+
+    Returns:
+        list: a dict with the number of workers, the time, the sentences/s and the speedup for every measurement
+    '''
+    results = []
+    for workers in range(1, (max_workers or os.cpu_count()) + 1):
+        with TranslationPool("tgl_Latn", "eng_Latn", version, finetuned=finetuned, workers=workers, **kwargs) as pool:
+            # Wait until every worker has loaded its model
+            pool.pool.map(_translate_shard, [[src[0]]] * workers, chunksize=1)
+
+            start = time.perf_counter()
+            for _ in pool.imap(src):
+                pass
+            elapsed = time.perf_counter() - start
+
+        result = {'workers': workers, 'threads_per_worker': pool.threads_per_worker, 'seconds': elapsed,
+                  'sentences_per_second': len(src) / elapsed}
+        result['speedup'] = result['sentences_per_second'] / results[0]['sentences_per_second'] if results else 1.0
+        results.append(result)
+        print("{workers} worker(s) x {threads_per_worker} thread(s): {sentences_per_second:.2f} sentences/s, speedup {speedup:.2f}".format(**result))
+
+    return results
@@ -0,0 +1,156 @@
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .predictions import ShardedPredictions
+
+import hashlib
+import json
+import os
+import time
+
+class ShardedPredictions:
+    '''
+    Predictions of a translation job stored as JSONL shards in a directory, so a job over a corpus of any size
+    keeps only one shard in memory, and a crashed or interrupted job can be restarted from its last complete shard.
+
+    A shard is written to shard-NNNNN.jsonl.partial line by line as the translations come in, flushed and fsynced
+    every sync_every lines, and renamed to shard-NNNNN.jsonl once it is complete. A rename is atomic, so a shard
+    without .partial is always whole, and an interrupted shard continues after its last complete line.
+    meta.json records the system, the split, the size of the job and a hash of all sources, so a directory is never
+    resumed for other data, and the predictions are scored against the references of the split they were made for.
+    '''
+
+    def __init__(self, directory:str, shard_size:int=2000, sync_every:int=200):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.sync_every = sync_every
+
+    def path(self, shard:int, partial:bool=False) -> str:
+        return os.path.join(self.directory, "shard-{:05d}.jsonl".format(shard) + (".partial" if partial else ""))
+
+    @property
+    def meta(self) -> dict:
+        with open(os.path.join(self.directory, "meta.json")) as f:
+            return json.load(f)
+
+    def fingerprint(self, total:int, sources) -> str:
+        '''
+        Returns:
+            str: a hash of every source sentence, read one shard at a time
+        '''
+        sha = hashlib.sha256(str(total).encode("utf-8"))
+        for start in range(0, total, self.shard_size):
+            for source in sources(start, min(total, start + self.shard_size)):
+                sha.update(source.encode("utf-8") + b"\n")
+        return sha.hexdigest()
+
+    def resume_partial(self, shard:int, batch:list, first:int) -> int:
+        '''
+        Keep the lines of an interrupted shard that were written completely and belong to the same sources,
+        and cut off the rest of the file.
+
+        Returns:
+            int: the number of sentences of the shard that are already translated
+        '''
+        path = self.path(shard, partial=True)
+        if not os.path.exists(path):
+            return 0
+
+        done = 0
+        size = 0
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b"\n") or done == len(batch) or entry.get("index") != first + done or entry.get("source") != batch[done]:
+                    break
+                done += 1
+                size += len(line)
+        with open(path, "r+b") as f:
+            f.truncate(size)
+        return done
+
+    def translate(self, total:int, sources, translate_function, system:str, split:str="test", streaming:bool=False) -> None:
+        '''
+        Translate all sources shard by shard, skipping the shards that are already complete, and continuing
+        an interrupted shard after its last line that was written completely.
+
+        Args:
+            total: the number of source sentences
+            sources: function that returns the source sentences from index start up to end, e.g. a slice of a dataset
+            translate_function: function that translates a list of sentences
+            system: the name of the translation system, stored with the predictions
+            split: the split the sources come from, stored with the predictions
+            streaming: whether translate_function yields the translations as they are done, e.g. TranslationPool.imap.
+                It then gets the rest of a shard at once, otherwise it is called for sync_every sentences at a time.
+
+        Raises:
+            ValueError: if the directory holds predictions of another system or split, other sources or another shard size
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        meta = {"system": system, "split": split, "total": total, "shard_size": self.shard_size, "fingerprint": self.fingerprint(total, sources)}
+
+        meta_path = os.path.join(self.directory, "meta.json")
+        if os.path.exists(meta_path):
+            # Predictions written before the split was recorded are of the test split
+            previous = dict({"split": "test"}, **self.meta)
+            keys = ["system", "split", "total", "shard_size", "fingerprint"]
+            if {key: previous.get(key) for key in keys} != {key: meta[key] for key in keys}:
+                raise ValueError(self.directory + " holds predictions of another system or split, for other sources or with another shard size")
+        else:
+            with open(meta_path, "w") as f:
+                json.dump(meta, f, indent=2)
+
+        shards = range((total + self.shard_size - 1) // self.shard_size)
+        done = [shard for shard in shards if os.path.exists(self.path(shard))]
+        if done:
+            print("Resuming: {} of {} shard(s) already complete".format(len(done), len(shards)))
+
+        for shard in shards:
+            if os.path.exists(self.path(shard)):
+                continue
+
+            start = time.perf_counter()
+            first = shard * self.shard_size
+            batch = sources(first, min(total, first + self.shard_size))
+            resumed = self.resume_partial(shard, batch, first)
+            if resumed:
+                print("Shard {}/{}: resuming after {} sentence(s)".format(shard + 1, len(shards), resumed))
+
+            if streaming:
+                translations = translate_function(batch[resumed:])
+            else:
+                translations = (translation for offset in range(resumed, len(batch), self.sync_every)
+                                for translation in translate_function(batch[offset:offset + self.sync_every]))
+
+            with open(self.path(shard, partial=True), "a", encoding="utf-8") as f:
+                for i, translation in enumerate(translations, resumed):
+                    f.write(json.dumps({"index": first + i, "source": batch[i], "prediction": translation}, ensure_ascii=False) + "\n")
+                    if (i + 1 - resumed) % self.sync_every == 0:
+                        f.flush()
+                        os.fsync(f.fileno())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.path(shard, partial=True), self.path(shard))
+
+            print("Shard {}/{} done ({} sentence(s), {:.1f}s)".format(shard + 1, len(shards), len(batch) - resumed, time.perf_counter() - start))
+
+    def complete(self) -> bool:
+        meta = self.meta
+        return all(os.path.exists(self.path(shard)) for shard in range((meta["total"] + meta["shard_size"] - 1) // meta["shard_size"]))
+
+    def __len__(self) -> int:
+        return self.meta["total"]
+
+    def __iter__(self):
+        '''
+        Yields:
+            str: the predictions in order, read one shard at a time
+        '''
+        assert self.complete(), self.directory + " is not complete, run the translation again to finish it"
+        meta = self.meta
+        for shard in range((meta["total"] + meta["shard_size"] - 1) // meta["shard_size"]):
+            with open(self.path(shard), encoding="utf-8") as f:
+                for line in f:
+                    yield json.loads(line)["prediction"]
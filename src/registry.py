@@ -0,0 +1,87 @@
+'''
+Process-wide registry of tokenizers, models and metrics. Everything is loaded the first time it is asked for and shared
+by all later callers, so e.g. an Evaluation and an NLLBTranslator use the same tokenizer instead of loading it twice.
+
+Shared models are shared objects: finetuning one changes it for every holder, which is why finetuning forgets the
+model here, so translators created afterwards load fresh weights.
+'''
+import threading
+
+BASE_MODEL = "facebook/nllb-200-distilled-600M"
+
+_tokenizers = {}
+_models = {}
+_metrics = {}
+_lock = threading.RLock()
+
+def tokenizer(name:str=BASE_MODEL, src_lang:str="tgl_Latn", tgt_lang:str="eng_Latn"):
+    '''
+    Returns:
+        NllbTokenizer: the shared tokenizer for the given model and language pair
+    '''
+    key = (name, src_lang, tgt_lang)
+    with _lock:
+        if key not in _tokenizers:
+            from transformers import NllbTokenizer
+            _tokenizers[key] = NllbTokenizer.from_pretrained(name, src_lang=src_lang, tgt_lang=tgt_lang)
+        return _tokenizers[key]
+
+def model(path:str=BASE_MODEL, engine:str="torch"):
+    '''
+    Returns:
+        the shared translation model for the given checkpoint and inference engine
+    '''
+    key = (path, engine)
+    with _lock:
+        if key not in _models:
+            from .nllbtranslator import NLLBTranslator
+            _models[key] = NLLBTranslator.load_model(path, engine)
+        return _models[key]
+
+def metric(name:str):
+    '''
+    Returns:
+        evaluate.EvaluationModule: the shared metric, e.g. "sacrebleu" or "comet"
+    '''
+    with _lock:
+        if name not in _metrics:
+            import evaluate
+            _metrics[name] = evaluate.load(name)
+        return _metrics[name]
+
+def register_tokenizer(tokenizer, name:str=BASE_MODEL, src_lang:str="tgl_Latn", tgt_lang:str="eng_Latn") -> None:
+    '''
+    Use an already loaded tokenizer for the given model and language pair.
+    '''
+    with _lock:
+        _tokenizers[(name, src_lang, tgt_lang)] = tokenizer
+
+def register_model(model, path:str=BASE_MODEL, engine:str="torch") -> None:
+    '''
+    Use an already loaded model for the given checkpoint and inference engine.
+    '''
+    with _lock:
+        _models[(path, engine)] = model
+
+def register_metric(metric, name:str) -> None:
+    '''
+    Use an already loaded metric under the given name, e.g. an offline BLEU implementation for "sacrebleu".
+    '''
+    with _lock:
+        _metrics[name] = metric
+
+def forget_model(path:str=BASE_MODEL, engine:str=None) -> None:
+    '''
+    Drop a model from the registry, for all engines if no engine is given. Holders of the model keep their reference.
+    '''
+    with _lock:
+        for key in [key for key in _models if key[0] == path and engine in (None, key[1])]:
+            del _models[key]
+
+def forget_tokenizer(name:str) -> None:
+    '''
+    Drop a tokenizer from the registry, for all language pairs. Holders of the tokenizer keep their reference.
+    '''
+    with _lock:
+        for key in [key for key in _tokenizers if key[0] == name]:
+            del _tokenizers[key]
@@ -0,0 +1,308 @@
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .server import MicroBatcher, TranslationServer
+
+from .nllbtranslator import NLLBTranslator
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import json
+import time
+
+class QueueFull(Exception):
+    '''
+    Raised when a request would grow the queue beyond its limit, answered with HTTP 503.
+    '''
+
+class ServerMetrics:
+    '''
+    Counters of the translation service: requests, rejections, timeouts, the sizes of the generate batches,
+    and the latencies of the last `window` sentences for the percentiles.
+    '''
+
+    buckets = [1, 2, 4, 8, 16, 32, 64, 128]
+
+    def __init__(self, window:int=10000):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.sentences = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched = 0
+        self.batch_sizes = {bucket: 0 for bucket in self.buckets}
+        self.latencies = deque(maxlen=window)
+
+    def batch(self, size:int) -> None:
+        self.batches += 1
+        self.batched += size
+        for bucket in self.buckets:
+            if size <= bucket:
+                self.batch_sizes[bucket] += 1
+                return
+        self.batch_sizes[self.buckets[-1]] += 1
+
+    def percentile(self, q:float) -> float:
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(round(q * (len(latencies) - 1))))]
+
+    def summary(self, queue_depth:int) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "uptime_seconds": elapsed,
+            "queue_depth": queue_depth,
+            "requests": self.requests,
+            "sentences": self.sentences,
+            "sentences_per_second": self.sentences / elapsed if elapsed else 0.0,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "batches": self.batches,
+            "mean_batch_size": self.batched / self.batches if self.batches else 0.0,
+            "batch_size_histogram": {"le_" + str(bucket): count for bucket, count in self.batch_sizes.items()},
+            "latency_ms": {"p50": self.percentile(0.5) * 1000, "p90": self.percentile(0.9) * 1000, "p99": self.percentile(0.99) * 1000},
+        }
+
+class MicroBatcher:
+    '''
+    Collects the sentences of concurrent requests in a queue and translates them together: a batch is closed when it
+    has max_batch_size sentences or when the first sentence in it has waited max_wait_ms. The model runs in a single
+    worker thread, so the event loop keeps accepting and queueing requests while a batch is generated.
+    '''
+
+    def __init__(self, translate_batch, max_batch_size:int=32, max_wait_ms:float=5.0, max_queue:int=1024, timeout:float=30.0):
+        self.translate_batch = translate_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.metrics = ServerMetrics()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.worker = None
+
+    def start(self) -> None:
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown(wait=True)
+
+    async def translate(self, texts:list) -> list:
+        '''
+        Queue the sentences of a single request and wait for their translations.
+
+        Raises:
+            QueueFull: if the queue has no room for the sentences
+            asyncio.TimeoutError: if the translations take longer than the timeout
+        '''
+        if self.queue.qsize() + len(texts) > self.max_queue:
+            self.metrics.rejected += 1
+            raise QueueFull()
+
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        futures = []
+        for text in texts:
+            future = loop.create_future()
+            futures.append(future)
+            self.queue.put_nowait((text, future))
+
+        try:
+            translations = await asyncio.wait_for(asyncio.gather(*futures), self.timeout)
+        except asyncio.TimeoutError:
+            # Cancelled sentences that are still queued are skipped by the worker
+            self.metrics.timeouts += 1
+            raise
+
+        latency = time.monotonic() - start
+        self.metrics.requests += 1
+        self.metrics.sentences += len(texts)
+        self.metrics.latencies.extend([latency] * len(texts))
+        return translations
+
+    async def next_batch(self) -> list:
+        '''
+        Returns:
+            list: the (text, future) pairs of the next batch, waiting at most max_wait for more after the first one
+        '''
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return [(text, future) for text, future in batch if not future.done()]
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            if not batch:
+                continue
+
+            self.metrics.batch(len(batch))
+            try:
+                translations = await loop.run_in_executor(self.executor, self.translate_batch, [text for text, _ in batch])
+            except Exception as e:
+                self.metrics.errors += 1
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), translation in zip(batch, translations):
+                if not future.done():
+                    future.set_result(translation)
+
+class TranslationServer:
+    '''
+    Minimal HTTP/1.1 service around an NLLBTranslator, on asyncio streams so it needs no web framework.
+
+    Endpoints:
+        POST /translate   {"text": "..."} or {"texts": ["...", ...]}  ->  {"translation": "..."} or {"translations": [...]}
+        GET  /health      status, model and queue depth
+        GET  /metrics     queue depth, batch size histogram, latency percentiles and counters
+
+    Requests that do not fit in the queue get 503 with a Retry-After header, requests that are not translated
+    within the timeout get 504.
+    '''
+
+    def __init__(self, translator:NLLBTranslator, host:str="127.0.0.1", port:int=8000, max_batch_size:int=32,
+                 max_wait_ms:float=5.0, max_queue:int=1024, timeout:float=30.0, model_name:str=None):
+        self.translator = translator
+        self.host = host
+        self.port = port
+        self.model_name = model_name or translator.model_path(translator.version, translator.finetuned)
+        self.batcher = MicroBatcher(lambda texts: translator.translate_uncached(texts, batch_size=max_batch_size, progress=False),
+                                    max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, max_queue=max_queue, timeout=timeout)
+        self.server = None
+
+    async def start(self) -> None:
+        self.batcher.start()
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        print("Serving " + self.model_name + " on http://{}:{}".format(self.host, self.port))
+
+    async def stop(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+        await self.batcher.stop()
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> None:
+        # Keep-alive: serve requests on the connection until the client closes it
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode("latin-1").split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, response, extra_headers = await self.respond(method, path.split("?")[0], body)
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                self.write(writer, status, response, extra_headers, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, method:str, path:str, body:bytes) -> tuple:
+        '''
+        Returns:
+            tuple: the status code, the JSON response and extra headers
+        '''
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok", "model": self.model_name, "queue_depth": self.batcher.queue.qsize()}, {}
+        if method == "GET" and path == "/metrics":
+            return 200, self.batcher.metrics.summary(self.batcher.queue.qsize()), {}
+        if path != "/translate":
+            return 404, {"error": "not found"}, {}
+        if method != "POST":
+            return 405, {"error": "use POST"}, {}
+
+        try:
+            request = json.loads(body)
+            single = "text" in request
+            texts = [request["text"]] if single else list(request["texts"])
+            assert all(isinstance(text, str) for text in texts)
+        except (ValueError, KeyError, TypeError, AssertionError):
+            return 400, {"error": "expected {\"text\": str} or {\"texts\": [str, ...]}"}, {}
+
+        try:
+            translations = await self.batcher.translate(texts)
+        except QueueFull:
+            return 503, {"error": "queue full"}, {"Retry-After": "1"}
+        except asyncio.TimeoutError:
+            return 504, {"error": "timed out"}, {}
+        except Exception as e:
+            return 500, {"error": str(e)}, {}
+
+        return 200, {"translation": translations[0]} if single else {"translations": translations}, {}
+
+    def write(self, writer:asyncio.StreamWriter, status:int, response:dict, extra_headers:dict, keep_alive:bool) -> None:
+        reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error",
+                   503: "Service Unavailable", 504: "Gateway Timeout"}
+        body = json.dumps(response, ensure_ascii=False).encode("utf-8")
+        headers = {"Content-Type": "application/json; charset=utf-8", "Content-Length": str(len(body)),
+                   "Connection": "keep-alive" if keep_alive else "close"} | extra_headers
+        head = "HTTP/1.1 {} {}\r\n".format(status, reasons[status]) + "".join(name + ": " + value + "\r\n" for name, value in headers.items())
+        writer.write(head.encode("latin-1") + b"\r\n" + body)
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve Tagalog to English translation over HTTP with dynamic micro-batching")
+    parser.add_argument("--version", default="base", help="the version of the finetuned model, with --finetuned")
+    parser.add_argument("--finetuned", action="store_true", help="serve finetuned_<version>/ instead of the base model")
+    parser.add_argument("--engine", default="torch", choices=["torch", "int8", "onnx"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    parser.add_argument("--max-queue", type=int, default=1024, help="maximum number of queued sentences before requests get 503")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds before a request gets 504")
+    args = parser.parse_args()
+
+    translator = NLLBTranslator(src="tgl_Latn", tgt="eng_Latn", version=args.version, finetuned=args.finetuned, engine=args.engine)
+    server = TranslationServer(translator, host=args.host, port=args.port, max_batch_size=args.max_batch_size,
+                               max_wait_ms=args.max_wait_ms, max_queue=args.max_queue, timeout=args.timeout)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
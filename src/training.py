@@ -0,0 +1,269 @@
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .training import TokenBudgetBatchSampler, ThroughputCallback, FinetuningTrainer
+
+import hashlib
+import json
+import math
+import os
+import random
+import time
+import psutil
+import torch
+from torch.utils.data import DataLoader
+from transformers import Seq2SeqTrainer, TrainerCallback
+from datasets import load_from_disk
+from datasets.dataset_dict import DatasetDict
+
+PREFIX = "translate Tagalog to English: "
+
+def tokenize_function(examples:dict, tokenizer, max_length:int=128, source_lang:str="tg", target_lang:str="en") -> dict:
+    '''
+    Tokenize a batch of translation pairs for finetuning. This is a plain function instead of a method, so the parallel
+    workers of Dataset.map only have to receive the tokenizer and not the whole translator with its model.
+
+    Args:
+        examples: the batch of raw examples
+        tokenizer: the tokenizer of the model
+        max_length: the maximum number of tokens of the source and the target
+
+    Returns:
+        dict: the model inputs, the labels and the length (source plus target tokens) of every example
+    '''
+    inputs = [PREFIX + example[source_lang] for example in examples["translation"]]
+    targets = [example[target_lang] for example in examples["translation"]]
+
+    model_inputs = tokenizer(inputs, text_target=targets, max_length=max_length, truncation=True)
+    model_inputs["length"] = [len(source) + len(target) for source, target in zip(model_inputs["input_ids"], model_inputs["labels"])]
+    return model_inputs
+
+def tokenized_dataset(parallel:DatasetDict, tokenizer, max_length:int=128, num_proc:int=None, cache_dir:str="tokenized") -> DatasetDict:
+    '''
+    Tokenize the parallel dataset, or load it from disk if the same data was already tokenized with the same tokenizer
+    and max_length.
+
+    Args:
+        parallel: the parallel dataset
+        tokenizer: the tokenizer of the model
+        max_length: the maximum number of tokens of the source and the target
+        num_proc: the number of processes to tokenize with, one per CPU if None
+        cache_dir: the directory to keep the tokenized datasets in
+
+    Returns:
+        DatasetDict: the tokenized dataset with a "length" column
+    '''
+    # The fingerprints of the splits change with their content, so a new split is never mistaken for an old one
+    key = json.dumps({
+        "tokenizer": tokenizer.name_or_path,
+        "vocab_size": len(tokenizer),
+        "src_lang": tokenizer.src_lang,
+        "tgt_lang": tokenizer.tgt_lang,
+        "max_length": max_length,
+        "prefix": PREFIX,
+        "splits": {split: parallel[split]._fingerprint for split in parallel},
+    }, sort_keys=True)
+    path = os.path.join(cache_dir, hashlib.sha256(key.encode("utf-8")).hexdigest()[:16])
+
+    if os.path.exists(os.path.join(path, "dataset_dict.json")):
+        print("Loading tokenized dataset from " + path)
+        return load_from_disk(path)
+
+    if num_proc is None:
+        num_proc = os.cpu_count()
+    # Starting the workers costs more than it saves on small datasets
+    num_proc = max(1, min(num_proc, min(len(parallel[split]) for split in parallel) // 1000))
+
+    start = time.perf_counter()
+    tokenized = DatasetDict({split: dataset.map(tokenize_function, batched=True, num_proc=num_proc if num_proc > 1 else None,
+                                                fn_kwargs={"tokenizer": tokenizer, "max_length": max_length},
+                                                remove_columns=dataset.column_names)
+                             for split, dataset in parallel.items()})
+    tokenized.save_to_disk(path)
+    with open(os.path.join(path, "key.json"), 'w') as f:
+        f.write(key)
+    print("Tokenized dataset in {:.1f}s with {} process(es), saved to {}".format(time.perf_counter() - start, num_proc, path))
+
+    return load_from_disk(path)
+
+class TokenBudgetBatchSampler:
+    '''
+    Batches examples of similar length so that no batch has more than max_tokens tokens including padding,
+    instead of a fixed number of examples. Short examples give large batches and long ones small batches,
+    so memory use stays about the same for every step.
+
+    The batches are fixed once, and only their order is shuffled every epoch, which keeps the number of steps constant.
+    '''
+
+    def __init__(self, lengths:list, max_tokens:int, max_batch_size:int=None, shuffle:bool=True, seed:int=42):
+        self.shuffle = shuffle
+        self.random = random.Random(seed)
+
+        self.batches = []
+        batch = []
+        longest = 0
+        for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+            longest_with = max(longest, lengths[i])
+            if batch and (longest_with * (len(batch) + 1) > max_tokens or len(batch) == max_batch_size):
+                self.batches.append(batch)
+                batch = []
+                longest_with = lengths[i]
+            batch.append(i)
+            longest = longest_with
+        if batch:
+            self.batches.append(batch)
+
+    def __iter__(self):
+        batches = list(self.batches)
+        if self.shuffle:
+            self.random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+class ThroughputCallback(TrainerCallback):
+    '''
+    Reports the training throughput and the peak memory of every epoch.
+    The number of tokens per epoch is taken from the "length" column of the training data.
+    '''
+
+    def __init__(self, tokens:int, samples:int):
+        self.tokens = tokens
+        self.samples = samples
+        self.process = psutil.Process()
+        self.epochs = []
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self.start = time.perf_counter()
+        self.start_step = state.global_step
+        self.peak_rss = self.process.memory_info().rss
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        seconds = time.perf_counter() - self.start
+
+        # Only part of an epoch is trained if training stops at max_steps
+        fraction = min(1.0, (state.global_step - self.start_step) / max(1, state.max_steps / max(1, args.num_train_epochs)))
+        epoch = {
+            "epoch": round(state.epoch or 0, 2),
+            "seconds": seconds,
+            "tokens_per_second": self.tokens * fraction / seconds,
+            "samples_per_second": self.samples * fraction / seconds,
+            "peak_rss_mb": self.peak_rss / 2**20,
+        }
+        if torch.cuda.is_available():
+            epoch["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 2**20
+        self.epochs.append(epoch)
+
+        print("Epoch {epoch}: {tokens_per_second:.0f} tokens/s, {samples_per_second:.1f} samples/s, "
+              "peak RSS {peak_rss_mb:.0f} MB ({seconds:.1f}s)".format(**epoch))
+
+class FinetuningTrainer(Seq2SeqTrainer):
+    '''
+    Seq2SeqTrainer that can batch the training data by a token budget (see TokenBudgetBatchSampler)
+    instead of a fixed number of examples per batch.
+
+    With fast_eval, the evaluations during training only look at a fixed subsample of the validation data that
+    is stratified by length, decode greedily with at most eval_max_new_tokens new tokens, or with eval_loss_only
+    only compute the loss and perplexity without generating. Every full_eval_every evaluations, and with
+    full_evaluate after training, the whole validation set is evaluated as usual.
+
+    The time spent in compute_metrics is logged as metric_runtime and the rest of the evaluation as generation_runtime.
+    '''
+
+    def __init__(self, *args, max_tokens:int=None, fast_eval:bool=False, eval_samples:int=200, eval_max_new_tokens:int=64,
+                 eval_loss_only:bool=False, full_eval_every:int=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_tokens = max_tokens
+        self.fast_eval = fast_eval
+        self.eval_samples = eval_samples
+        self.eval_max_new_tokens = eval_max_new_tokens
+        self.eval_loss_only = eval_loss_only
+        self.full_eval_every = full_eval_every
+        self.evaluations = 0
+        self.last_eval_full = False
+        self.loss_only = False
+
+        self.metric_seconds = 0.0
+        if self.compute_metrics is not None:
+            compute_metrics = self.compute_metrics
+            def timed_compute_metrics(predictions):
+                start = time.perf_counter()
+                metrics = compute_metrics(predictions)
+                self.metric_seconds += time.perf_counter() - start
+                return metrics
+            self.compute_metrics = timed_compute_metrics
+
+    def get_train_dataloader(self) -> DataLoader:
+        if self.max_tokens is None:
+            return super().get_train_dataloader()
+
+        # The lengths are needed before _remove_unused_columns drops the "length" column
+        sampler = TokenBudgetBatchSampler(self.train_dataset["length"], self.max_tokens, shuffle=True, seed=self.args.seed)
+        train_dataset = self._remove_unused_columns(self.train_dataset, description="training")
+
+        return self.accelerator.prepare(DataLoader(
+            train_dataset,
+            batch_sampler=sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        ))
+
+    def eval_subsample(self):
+        '''
+        Returns:
+            Dataset: eval_samples examples of the validation data, one random example out of every range of lengths,
+                the same ones for every evaluation
+        '''
+        if not hasattr(self, "_eval_subsample"):
+            dataset = self.eval_dataset
+            if len(dataset) <= self.eval_samples:
+                self._eval_subsample = dataset
+            else:
+                generator = random.Random(self.args.seed)
+                lengths = dataset["length"] if "length" in dataset.column_names else [0] * len(dataset)
+                order = sorted(range(len(dataset)), key=lambda i: lengths[i])
+                strata = [order[len(order) * k // self.eval_samples:len(order) * (k + 1) // self.eval_samples] for k in range(self.eval_samples)]
+                self._eval_subsample = dataset.select(sorted(generator.choice(stratum) for stratum in strata))
+        return self._eval_subsample
+
+    def evaluate(self, eval_dataset=None, ignore_keys=None, metric_key_prefix:str="eval", **gen_kwargs) -> dict:
+        if not self.fast_eval or eval_dataset is not None:
+            return super().evaluate(eval_dataset, ignore_keys=ignore_keys, metric_key_prefix=metric_key_prefix, **gen_kwargs)
+
+        self.evaluations += 1
+        self.last_eval_full = bool(self.full_eval_every) and self.evaluations % self.full_eval_every == 0
+        if self.last_eval_full:
+            return self.full_evaluate(ignore_keys=ignore_keys, metric_key_prefix=metric_key_prefix, **gen_kwargs)
+
+        gen_kwargs = {"num_beams": 1, "max_new_tokens": self.eval_max_new_tokens} | gen_kwargs
+        self.loss_only = self.eval_loss_only
+        try:
+            return super().evaluate(self.eval_subsample(), ignore_keys=ignore_keys, metric_key_prefix=metric_key_prefix, **gen_kwargs)
+        finally:
+            self.loss_only = False
+
+    def full_evaluate(self, ignore_keys=None, metric_key_prefix:str="eval", **gen_kwargs) -> dict:
+        '''
+        Evaluate on the whole validation set with the normal generation settings, also when fast_eval is on.
+        '''
+        return super().evaluate(self.eval_dataset, ignore_keys=ignore_keys, metric_key_prefix=metric_key_prefix, **gen_kwargs)
+
+    def evaluation_loop(self, dataloader, description, prediction_loss_only=None, ignore_keys=None, metric_key_prefix:str="eval"):
+        start = time.perf_counter()
+        self.metric_seconds = 0.0
+
+        output = super().evaluation_loop(dataloader, description, prediction_loss_only=prediction_loss_only or self.loss_only or None,
+                                         ignore_keys=ignore_keys, metric_key_prefix=metric_key_prefix)
+
+        output.metrics[metric_key_prefix + "_metric_runtime"] = self.metric_seconds
+        output.metrics[metric_key_prefix + "_generation_runtime"] = time.perf_counter() - start - self.metric_seconds
+        output.metrics[metric_key_prefix + "_samples"] = len(dataloader.dataset)
+        if metric_key_prefix + "_loss" in output.metrics:
+            output.metrics[metric_key_prefix + "_perplexity"] = math.exp(min(output.metrics[metric_key_prefix + "_loss"], 100))
+        return output
@@ -0,0 +1,253 @@
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .trim import VocabularyTrimmer
+
+from .nllbtranslator import NLLBTranslator
+from .evaluation import Evaluation
+from .data import Data
+from . import registry
+import copy
+import json
+import os
+import time
+import torch
+from datasets.dataset_dict import DatasetDict
+
+class VocabularyTrimmer:
+    '''
+    Exports a copy of a translation model with only the part of the ~256k token multilingual vocabulary that a corpus
+    actually uses, which shrinks the embedding matrix and the softmax of every decoding step. The trimmed model and its
+    tokenizer are saved as finetuned_<version>/ with a trimmed_vocabulary.json marker, so they load like any finetuned
+    checkpoint and NLLBTranslator knows to use the tokenizer saved with them.
+
+    Kept are the sentencepiece pieces that occur in the corpus, the control, unknown, user defined and byte pieces,
+    the single characters of Latin script and of the corpus (so unseen words still tokenize without <unk>),
+    all special and language tokens, and for BPE models every piece that is merged on the way to a kept piece.
+    The pieces keep their order and scores, so every sentence of the corpus is tokenized exactly as before.
+    '''
+
+    # Single characters below this code point (Basic Latin up to Latin Extended-B) are always kept
+    latin = 0x0250
+
+    def __init__(self, translator:NLLBTranslator):
+        assert translator.engine == "torch", "only the weights of the torch engine can be trimmed, quantize or export the trimmed model afterwards"
+        self.translator = translator
+        self.tokenizer = translator.tokenizer
+
+    def scan(self, parallel:DatasetDict, batch_size:int=10000) -> tuple:
+        '''
+        Tokenize both sides of every split of the corpus.
+
+        Returns:
+            tuple: the set of used sentencepiece pieces and the set of characters in the corpus
+        '''
+        data = Data()
+        sp_model = self.tokenizer.sp_model
+        pieces = set()
+        characters = set()
+        for split in parallel:
+            for texts in [data.sources(parallel, split), data.references(parallel, split)]:
+                for start in range(0, len(texts), batch_size):
+                    batch = texts[start:start + batch_size]
+                    for encoded in sp_model.encode(batch, out_type=str):
+                        pieces.update(encoded)
+                    for text in batch:
+                        characters.update(text)
+        return pieces, characters
+
+    def merge_pieces(self, piece:str, scores:dict) -> set:
+        '''
+        Replay the BPE merges that build a piece from its characters: the adjacent pair with the highest score
+        (the leftmost one on ties) is merged until no pair is a piece.
+
+        Returns:
+            set: the piece and every piece that is created on the way to it
+        '''
+        symbols = list(piece)
+        created = set(symbols)
+        while len(symbols) > 1:
+            best = None
+            for i in range(len(symbols) - 1):
+                merged = symbols[i] + symbols[i + 1]
+                if merged in scores and (best is None or scores[merged] > scores[symbols[best] + symbols[best + 1]]):
+                    best = i
+            if best is None:
+                break
+            symbols[best:best + 2] = [symbols[best] + symbols[best + 1]]
+            created.add(symbols[best])
+        return created
+
+    def prune(self, used:set, characters:set):
+        '''
+        Returns:
+            ModelProto: the sentencepiece model with only the pieces to keep, in their original order
+        '''
+        try:
+            from sentencepiece import sentencepiece_model_pb2 as model_pb2
+        except ImportError:
+            raise ImportError("Trimming the vocabulary needs protobuf: pip install protobuf")
+
+        proto = model_pb2.ModelProto()
+        proto.ParseFromString(self.tokenizer.sp_model.serialized_model_proto())
+        normal = model_pb2.ModelProto.SentencePiece.NORMAL
+
+        keep = set(used)
+        if proto.trainer_spec.model_type == model_pb2.TrainerSpec.BPE:
+            scores = {piece.piece: piece.score for piece in proto.pieces if piece.type == normal}
+            for piece in used:
+                keep |= self.merge_pieces(piece, scores)
+
+        pieces = [piece for piece in proto.pieces
+                  if piece.type != normal or piece.piece in keep
+                  or (len(piece.piece) == 1 and (ord(piece.piece) < self.latin or piece.piece in characters))]
+        del proto.pieces[:]
+        proto.pieces.extend(pieces)
+        return proto
+
+    def trim_model(self, model, old_ids:list):
+        '''
+        Keep the rows of the embeddings and the output layer of the given token ids, in the given order.
+        '''
+        index = torch.tensor(old_ids)
+        embeddings = model.get_input_embeddings()
+        embeddings.weight = torch.nn.Parameter(embeddings.weight.data[index].clone())
+        embeddings.num_embeddings = len(old_ids)
+
+        output = model.get_output_embeddings()
+        if model.config.tie_word_embeddings:
+            model.tie_weights()
+        else:
+            output.weight = torch.nn.Parameter(output.weight.data[index].clone())
+        output.out_features = len(old_ids)
+        model.config.vocab_size = len(old_ids)
+
+        old_to_new = {old: new for new, old in enumerate(old_ids)}
+        for config in [model.config, model.generation_config]:
+            for name in ["pad_token_id", "bos_token_id", "eos_token_id", "decoder_start_token_id", "forced_bos_token_id", "forced_eos_token_id"]:
+                if getattr(config, name, None) is not None:
+                    setattr(config, name, old_to_new[getattr(config, name)])
+        embeddings.padding_idx = model.config.pad_token_id
+        return model
+
+    def export(self, parallel:DatasetDict, version:str) -> str:
+        '''
+        Scan the corpus, and save the trimmed model and tokenizer as finetuned_<version>/.
+
+        Args:
+            parallel: the corpus the model will be used on, all splits are scanned
+            version: the version to save the trimmed model as
+
+        Returns:
+            str: the directory of the trimmed model
+        '''
+        path = NLLBTranslator.model_path(version, finetuned=True)
+        os.makedirs(path, exist_ok=True)
+
+        start = time.perf_counter()
+        used, characters = self.scan(parallel)
+        proto = self.prune(used, characters)
+        print("Scanned the corpus in {:.1f}s: {} piece(s) used, {} of {} kept".format(
+            time.perf_counter() - start, len(used), len(proto.pieces), self.tokenizer.sp_model.get_piece_size()))
+
+        vocab_file = os.path.join(path, "sentencepiece.bpe.model")
+        with open(vocab_file, "wb") as f:
+            f.write(proto.SerializeToString())
+        tokenizer = type(self.tokenizer)(vocab_file=vocab_file, src_lang=self.tokenizer.src_lang, tgt_lang=self.tokenizer.tgt_lang)
+
+        # Every token of the new tokenizer, including the special and language tokens, by its id in the old one
+        tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+        old_ids = self.tokenizer.convert_tokens_to_ids(tokens)
+        unknown = [token for token, id in zip(tokens, old_ids) if id == self.tokenizer.unk_token_id and token != self.tokenizer.unk_token]
+        assert not unknown, "tokens missing from the original vocabulary: " + str(unknown[:10])
+
+        # A copy, so the shared model of the translator keeps its vocabulary
+        model = copy.deepcopy(self.translator.model)
+        parameters = model.num_parameters()
+        model = self.trim_model(model, old_ids)
+
+        model.save_pretrained(path)
+        tokenizer.save_pretrained(path)
+        with open(os.path.join(path, NLLBTranslator.trimmed_marker), "w") as f:
+            json.dump({"model": self.translator.model_path(self.translator.version, self.translator.finetuned),
+                       "vocabulary": len(tokenizer), "original_vocabulary": len(self.tokenizer),
+                       "pieces": len(proto.pieces), "original_pieces": self.tokenizer.sp_model.get_piece_size()}, f, indent=2)
+        registry.forget_model(path)
+        registry.forget_tokenizer(path)
+
+        print("Saved the trimmed model to {}: vocabulary {} -> {}, parameters {:.1f}M -> {:.1f}M".format(
+            path, len(self.tokenizer), len(tokenizer), parameters / 1e6, model.num_parameters() / 1e6))
+        return path
+
+    def verify_tokenization(self, texts:list, version:str) -> int:
+        '''
+        Returns:
+            int: the number of texts that the trimmed tokenizer does not tokenize exactly like the original one
+        '''
+        tokenizer = registry.tokenizer(NLLBTranslator.model_path(version, finetuned=True), self.tokenizer.src_lang, self.tokenizer.tgt_lang)
+        return sum(self.tokenizer.tokenize(text) != tokenizer.tokenize(text) for text in texts)
+
+    def generated_tokens(self, translator:NLLBTranslator, sources:list) -> list:
+        '''
+        Returns:
+            list: the tokens generated for every sentence, without padding. Tokens and not ids, because the ids of the
+                trimmed vocabulary differ from the original ones.
+        '''
+        tokens = []
+        for start in range(0, len(sources), translator.batch_size):
+            inputs = translator.tokenizer(sources[start:start + translator.batch_size], return_tensors="pt", padding=True)
+            with torch.inference_mode():
+                generated = translator.model.generate(**inputs, forced_bos_token_id=translator.tokenizer.convert_tokens_to_ids(translator.tgt))
+            for ids in generated.tolist():
+                tokens.append(translator.tokenizer.convert_ids_to_tokens([id for id in ids if id != translator.tokenizer.pad_token_id]))
+        return tokens
+
+    def parity_check(self, sources:list, labels:list, eval_class:Evaluation, version:str, sample_size:int=200) -> dict:
+        '''
+        Compare the trimmed model with the original one on a sample of the data: the scores of Evaluation.eval,
+        how many generated token sequences are identical, the time to translate, and the time to load the trimmed model.
+
+        Args:
+            sources: the text in the source language
+            labels: the text in the target language
+            eval_class: instance of the Evaluation class
+            version: the version the trimmed model was saved as
+            sample_size: the number of sentences to compare on
+
+        Returns:
+            dict: the scores and times of both models, and the BLEU and COMET delta of the trimmed model against the original
+        '''
+        sources = sources[:sample_size]
+        labels = labels[:sample_size]
+        original = self.translator
+
+        # The trimmed model is loaded once, timed, and used for the comparison
+        path = NLLBTranslator.model_path(version, finetuned=True)
+        registry.forget_model(path)
+        start = time.perf_counter()
+        trimmed = NLLBTranslator(original.src, original.tgt, version, finetuned=True, batch_size=original.batch_size, max_tokens=original.max_tokens)
+        load_seconds = time.perf_counter() - start
+
+        report = {}
+        tokens = {}
+        for name, translator in [("original", original), ("trimmed", trimmed)]:
+            # Warm up, so one-time initialisation is not part of the timing
+            translator.translate_uncached(sources[:1], progress=False)
+
+            start = time.perf_counter()
+            predictions = translator.translate_uncached(sources)
+            seconds = time.perf_counter() - start
+
+            tokens[name] = self.generated_tokens(translator, sources)
+            score = eval_class.eval(predictions, labels, sources)
+            report[name] = {'bleu': score['bleu']['score'], 'comet': score['comet']['mean_score'], 'seconds': seconds,
+                            'vocabulary': len(translator.tokenizer), 'parameters': translator.model.num_parameters()}
+        report["trimmed"]['load_seconds'] = load_seconds
+
+        report['bleu_delta'] = report["trimmed"]['bleu'] - report["original"]['bleu']
+        report['comet_delta'] = report["trimmed"]['comet'] - report["original"]['comet']
+        report['identical_tokens'] = sum(a == b for a, b in zip(tokens["original"], tokens["trimmed"])) / len(sources)
+        report['speedup'] = report["original"]['seconds'] / report["trimmed"]['seconds']
+
+        print("Trimmed vs original on " + str(len(sources)) + " sentence(s): BLEU delta {:.2f}, COMET delta {:.4f}, {:.1%} identical token sequences, speedup {:.2f}x, trimmed model loaded in {:.1f}s".format(
+            report['bleu_delta'], report['comet_delta'], report['identical_tokens'], report['speedup'], load_seconds))
+        return report